@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+`executor_buffmap.base_buffmap` 的 asyncio 版本
+
+Requirements:
+    python>=3.7 (async generator, asyncio.get_running_loop)
+
+Examples:
+    async def fetch(url, timeout=10):
+        ...
+
+    async for resp in async_buffmap(fetch, urls, common_kwargs={"timeout": 5}, buffsize=50):
+        ...
+"""
+import asyncio
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def async_buffmap(fn, *iterables, **kwargs):
+    """
+    与 `executor_buffmap.base_buffmap` 相同的语义:
+     - 同时运行的任务不超过 buffsize 个
+     - 一边运行一边展开 iterables
+     - 支持传入全局的kv参数 common_kwargs
+     - 乱序执行, 按完成的先后顺序返回结果
+     - 调用方停止迭代 (break/异常/aclose) 时取消所有未完成的任务
+
+    fn 可以是 `async def` 函数, 也可以是普通函数,
+      普通函数会通过 `loop.run_in_executor` 放到 executor 中运行 (默认为loop的默认线程池),
+      注意已经在线程中开始运行的普通函数无法被真正取消, 只会丢弃它的结果
+
+    timeout 是单个任务的超时时间 (秒), 超时的任务会被取消, 并向调用方抛出 asyncio.TimeoutError
+    """
+    common_kwargs = kwargs.pop("common_kwargs", {})
+    buffsize = kwargs.pop("buffsize", 16)
+    timeout = kwargs.pop("timeout", None)
+    executor = kwargs.pop("executor", None)
+
+    if kwargs:
+        raise ValueError("unknown kwargs: {}".format(kwargs))
+
+    loop = asyncio.get_running_loop()
+    is_coroutine = asyncio.iscoroutinefunction(fn)
+
+    pending = set()
+    done_queue = asyncio.Queue()
+
+    _iter = zip(*iterables)
+
+    def _fill_pending():
+        while len(pending) < buffsize:
+            try:
+                args = next(_iter)
+            except StopIteration:
+                return
+            if is_coroutine:
+                aw = fn(*args, **common_kwargs)
+            else:
+                aw = loop.run_in_executor(executor, functools.partial(fn, *args, **common_kwargs))
+            if timeout is not None:
+                aw = asyncio.wait_for(aw, timeout)
+            task = asyncio.ensure_future(aw)
+            task.add_done_callback(done_queue.put_nowait)
+            pending.add(task)
+
+    _fill_pending()
+
+    try:
+        while pending:
+            task = await done_queue.get()
+            _done_tasks = [task]
+            while not done_queue.empty():
+                _done_tasks.append(done_queue.get_nowait())
+            pending.difference_update(_done_tasks)
+
+            _fill_pending()  # 先填充再yield结果, 减少时间浪费
+
+            for task in _done_tasks:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            # 等待取消完成, 避免出现 "Task was destroyed but it is pending"
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def test_async_buffmap():
+    import time
+
+    running = [0, 0]  # 当前运行数, 最大运行数
+
+    async def _square(x, offset=0):
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.001 * (x % 5))
+        running[0] -= 1
+        return x * x + offset
+
+    def _sync_square(x, offset=0):
+        time.sleep(0.001 * (x % 5))
+        return x * x + offset
+
+    async def _collect(fn, *iterables, **kwargs):
+        return [x async for x in async_buffmap(fn, *iterables, **kwargs)]
+
+    loop = asyncio.new_event_loop()
+
+    results = loop.run_until_complete(_collect(_square, range(100), common_kwargs={"offset": 1}, buffsize=10))
+    assert sorted(results) == [x * x + 1 for x in range(100)]
+    assert running[1] == 10
+
+    results = loop.run_until_complete(_collect(_sync_square, range(50), common_kwargs={"offset": 1}))
+    assert sorted(results) == [x * x + 1 for x in range(50)]
+
+    async def _hang(x):
+        if x == 3:
+            await asyncio.sleep(10)
+        return x
+
+    try:
+        loop.run_until_complete(_collect(_hang, range(10), timeout=0.1))
+    except asyncio.TimeoutError:
+        pass
+    else:
+        assert False
+
+    # 无限的 iterable, 提前停止迭代时取消剩余任务
+    cancelled = []
+
+    async def _slow(x):
+        try:
+            await asyncio.sleep(0.01 if x < 5 else 10)
+        except asyncio.CancelledError:
+            cancelled.append(x)
+            raise
+        return x
+
+    async def _take(n):
+        import itertools
+        agen = async_buffmap(_slow, itertools.count(), buffsize=8)
+        results = []
+        async for x in agen:
+            results.append(x)
+            if len(results) == n:
+                break
+        await agen.aclose()
+        return results
+
+    assert sorted(loop.run_until_complete(_take(5))) == list(range(5))
+    assert cancelled and all(x >= 5 for x in cancelled)
+    assert not [t for t in asyncio.all_tasks(loop) if not t.done()]
+
+    loop.close()
+
+
+if __name__ == '__main__':
+    test_async_buffmap()
+    print("all tests passed!")
@@ -4,9 +4,13 @@ from __future__ import unicode_literals
 import sys
 import os
 import json
-import collections
 import tempfile
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 engines = {}
 best_engine = None
 
@@ -37,7 +41,7 @@ def _text_open(file,mode):
         return open(file, mode, encoding="utf8")
 
 
-class BaseDiskKV(collections.MutableMapping):
+class BaseDiskKV(MutableMapping):
     def __init__(self, db_folder=None, engine=None, auto_delete=None, block_cache_size=8 * (2 << 20)):
         if db_folder is None:
             self.db_folder = tempfile.mkdtemp(prefix="{}_".format(self.__class__.__name__))
@@ -123,6 +127,20 @@ class BaseDiskKV(collections.MutableMapping):
             value = self.value_encode(value)
         return self.engine.put(self.db, key, value)
     
+    def put_many(self, items):
+        """
+        批量写入 (key, value), 使用 leveldb 的 WriteBatch 一次提交, 比逐个 put 快很多
+        """
+        key_encode = self.key_encode
+        value_encode = self.value_encode
+        if key_encode is not None or value_encode is not None:
+            items = (
+                (key if key_encode is None else key_encode(key),
+                 value if value_encode is None else value_encode(value))
+                for key, value in items
+            )
+        return self.engine.put_batch(self.db, items)
+    
     def delete(self, key, decode=True):
         if self.key_encode is not None and decode:
             key = self.key_encode(key)
@@ -80,6 +80,15 @@ except ImportError:
         value = json.loads(value)
         return value
 else:
+    if msgpack.version >= (1, 0, 0):
+        # msgpack 1.0 移除了 encoding 参数, 并且默认不允许 bytes 作为 map 的 key
+        _unpack_kwargs = {"raw": False, "strict_map_key": False}
+    elif msgpack.version >= (0, 5, 2):
+        _unpack_kwargs = {"raw": False}
+    else:
+        _unpack_kwargs = {"encoding": "UTF-8"}
+    
+    
     def _value_encode(value):
         value = msgpack.dumps(value, use_bin_type=True)
         value = pack_timestamp(value)
@@ -88,7 +97,7 @@ else:
     
     def _value_decode(value):
         value = unpack_timestamp(value)[0]
-        value = msgpack.loads(value, encoding='UTF-8', use_list=False)
+        value = msgpack.loads(value, **_unpack_kwargs)
         return value
 
 
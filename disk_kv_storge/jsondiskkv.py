@@ -67,12 +67,21 @@ except ImportError:
     def _value_decode(value):
         return json.loads(value.decode("UTF-8"))
 else:
+    if msgpack.version >= (1, 0, 0):
+        # msgpack 1.0 移除了 encoding 参数, 并且默认不允许 bytes 作为 map 的 key
+        _unpack_kwargs = {"raw": False, "strict_map_key": False}
+    elif msgpack.version >= (0, 5, 2):
+        _unpack_kwargs = {"raw": False}
+    else:
+        _unpack_kwargs = {"encoding": "UTF-8"}
+    
+    
     def _value_encode(value):
         return msgpack.dumps(value, use_bin_type=True)
     
     
     def _value_decode(value):
-        return msgpack.loads(value, encoding='UTF-8', use_list=False)
+        return msgpack.loads(value, **_unpack_kwargs)
 
 
 # -------------------------
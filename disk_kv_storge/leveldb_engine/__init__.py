@@ -67,6 +67,12 @@ if _mode == "plyvel":
     keys = functools.partial(leveldb.DB.iterator, include_value=False)
     values = functools.partial(leveldb.DB.iterator, include_key=False)
     items = leveldb.DB.iterator
+    
+    
+    def put_batch(self, items):
+        with self.write_batch() as wb:
+            for key, value in items:
+                wb.put(key, value)
 
 elif _mode == "pyleveldb":
     open = leveldb.LevelDB
@@ -78,6 +84,13 @@ elif _mode == "pyleveldb":
     items = leveldb.LevelDB.RangeIter
     
     
+    def put_batch(self, items):
+        batch = leveldb.WriteBatch()
+        for key, value in items:
+            batch.Put(key, value)
+        self.Write(batch)
+    
+    
     def values(self, *args, **kwargs):
         for x in items(self, *args, **kwargs):
             yield x[1]
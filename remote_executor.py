@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+通过 TCP 把任务分发到多台机器上的 worker 进程的 executor,
+  与 concurrent.futures 的 executor 有相同的 submit/shutdown 接口, 可以直接交给 `executor_buffmap.base_buffmap`
+
+使用 `multiprocessing.connection` 的 Listener/Client 通信 (带长度头的 pickle 帧, authkey 做 HMAC 认证)
+  - worker 连上后声明自己的并发数 (slots), 主进程按 slots 给每个worker分发任务
+  - worker 每隔 heartbeat_interval 秒发送一次心跳,
+      超过 heartbeat_timeout 秒没有收到任何消息 (心跳或结果) 就认为该worker已经挂掉,
+      断开连接, 把它上面未完成的任务重新分发给其他worker
+  - 同一个任务最多重新分发 max_retries 次, 之后以 WorkerLostError 结束
+  - 函数和参数通过 pickle 传输, 函数必须能在worker端被 import
+  - 没有 authkey 时任何连上来的进程都能让主进程 unpickle 任意数据 (即执行任意代码),
+      所以监听非本机地址时必须提供 authkey
+
+Examples:
+    # 主进程
+    executor = RemoteExecutor(("0.0.0.0", 9527), authkey=b"secret", max_workers=16)
+    for result in base_buffmap(executor, parse, files):
+        ...
+
+    # 每台机器上启动worker
+    python remote_executor.py worker 10.0.0.1:9527 --slots 4 --authkey secret
+"""
+from __future__ import unicode_literals, division, print_function
+import os
+import sys
+import time
+import socket
+import ipaddress
+import logging
+import threading
+import collections
+
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+
+logger = logging.getLogger(__name__)
+
+
+def _is_loopback(host):
+    if host in ("localhost", "ip6-localhost"):
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class WorkerLostError(Exception):
+    """任务所在的worker挂掉, 并且重试次数已用完"""
+
+
+class _WorkItem(object):
+    __slots__ = ("id", "future", "fn", "args", "kwargs", "tries")
+
+    def __init__(self, id, future, fn, args, kwargs):
+        self.id = id
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.tries = 0
+
+
+class _HeartbeatTimeout(Exception):
+    pass
+
+
+class RemoteExecutor(Executor):
+    """
+    Args:
+        address (tuple): 监听的地址, 端口为0时自动选择, 实际地址见 `address` 属性
+        authkey (bytes): worker 连接时使用的认证密钥, 监听非 loopback 地址时必须提供
+        max_workers (int): 预期的总并发数, 用于 base_buffmap 的默认 buffsize.
+            worker连上之后 `_max_workers` 为所有worker的slots之和 (不小于这个值)
+        heartbeat_interval (float): worker 发送心跳的间隔
+        heartbeat_timeout (float): 多久没有收到消息认为worker已经挂掉
+        max_retries (int): 单个任务因为worker挂掉而重新分发的最大次数
+        poll_interval (float): 分发新任务的检查间隔
+    """
+
+    def __init__(self, address=("127.0.0.1", 0), authkey=None, max_workers=1,
+                 heartbeat_interval=1.0, heartbeat_timeout=5.0, max_retries=3,
+                 poll_interval=0.01):
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self._expected_workers = max_workers
+
+        self._queue = collections.deque()  # 等待分发的 _WorkItem
+        # 保护 _queue, _workers 和计数器, serve线程和调用方线程都会访问
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._shutdown = False
+        self._workers = {}  # name -> slots
+        self._threads = []
+        self.lost_workers = 0
+        self.resubmitted = 0
+
+        if authkey is None and not _is_loopback(address[0]):
+            raise ValueError("authkey is required when listening on non-loopback address {!r}".format(address[0]))
+        self._listener = Listener(tuple(address), authkey=authkey)
+        self._address = self._listener.address
+        self._accept_thread = threading.Thread(target=self._accept_loop, name="remote-executor-accept")
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def _max_workers(self):
+        with self._lock:
+            return max(sum(self._workers.values()), self._expected_workers)
+
+    @property
+    def workers(self):
+        """当前连接的 worker名 -> slots"""
+        with self._lock:
+            return dict(self._workers)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._next_id += 1
+            self._queue.append(_WorkItem(self._next_id, future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        停止接受新任务, wait=True 时等待已提交的任务全部完成 (需要有worker在线),
+          之后通知所有worker退出
+        """
+        with self._lock:
+            self._shutdown = True
+        # 不再接受新的worker, 已经连上的worker不受影响
+        self._close_listener()
+        if not wait:
+            # 已经被取消的任务不会再分发, 其他任务由仍然在线的worker完成后再退出
+            return
+        for thread in list(self._threads):
+            thread.join()
+
+    def _close_listener(self):
+        try:
+            self._listener.close()
+        except Exception:
+            pass
+        # 阻塞在 accept 中的线程会让监听的socket一直存在, 连接一次把它唤醒
+        if self._accept_thread.is_alive():
+            host, port = self._address[:2]
+            host = {"0.0.0.0": "127.0.0.1", "::": "::1"}.get(host, host)
+            try:
+                socket.create_connection((host, port), timeout=1).close()
+            except (OSError, socket.error):
+                pass
+            self._accept_thread.join(1)
+
+    def _accept_loop(self):
+        while not self._shutdown:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._shutdown:
+                    return
+                logger.warning("failed to accept worker", exc_info=True)
+                continue
+            if self._shutdown:
+                conn.close()
+                return
+            thread = threading.Thread(target=self._serve_worker, args=(conn,))
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def _take(self):
+        """取一个未被取消的任务, 没有时返回 None"""
+        with self._lock:
+            while self._queue:
+                item = self._queue.popleft()
+                if item.future.done():
+                    continue
+                if item.tries or item.future.set_running_or_notify_cancel():
+                    return item
+        return None
+
+    def _requeue(self, items, name):
+        with self._lock:
+            for item in items:
+                item.tries += 1
+                if item.tries > self.max_retries:
+                    item.future.set_exception(WorkerLostError(
+                        "worker {} lost, task {} exceeded max_retries={}".format(name, item.id, self.max_retries)))
+                else:
+                    self.resubmitted += 1
+                    self._queue.appendleft(item)
+
+    def _idle(self):
+        with self._lock:
+            return self._shutdown and not self._queue
+
+    def _serve_worker(self, conn):
+        try:
+            hello = conn.recv()
+            _, slots, name = hello
+            conn.send(("welcome", self.heartbeat_interval))
+        except Exception:
+            logger.warning("bad handshake from worker", exc_info=True)
+            conn.close()
+            return
+
+        name = "{}#{}".format(name, id(conn))
+        with self._lock:
+            self._workers[name] = slots
+        logger.info("worker {} connected, slots={}".format(name, slots))
+
+        inflight = {}
+        last_seen = time.time()
+        try:
+            while True:
+                while len(inflight) < slots:
+                    item = self._take()
+                    if item is None:
+                        break
+                    try:
+                        conn.send(("task", item.id, item.fn, item.args, item.kwargs))
+                    except (EOFError, OSError):
+                        self._requeue([item], name)
+                        raise
+                    except Exception as e:  # 无法pickle
+                        item.future.set_exception(e)
+                    else:
+                        inflight[item.id] = item
+
+                if not inflight and self._idle():
+                    conn.send(("stop",))
+                    break
+
+                if conn.poll(self.poll_interval):
+                    message = conn.recv()
+                    last_seen = time.time()
+                    if message[0] == "result":
+                        _, task_id, ok, value = message
+                        item = inflight.pop(task_id, None)
+                        if item is not None and not item.future.done():
+                            if ok:
+                                item.future.set_result(value)
+                            else:
+                                item.future.set_exception(value)
+                elif time.time() - last_seen > self.heartbeat_timeout:
+                    raise _HeartbeatTimeout("no heartbeat in {}s".format(self.heartbeat_timeout))
+        except (EOFError, OSError, _HeartbeatTimeout) as e:
+            with self._lock:
+                self.lost_workers += 1
+            logger.warning("worker {} lost ({!r}), resubmitting {} task(s)".format(name, e, len(inflight)))
+        except Exception:
+            # 例如结果在主进程中无法 unpickle, 断开这个worker
+            with self._lock:
+                self.lost_workers += 1
+            logger.exception("error serving worker {}, resubmitting {} task(s)".format(name, len(inflight)))
+        finally:
+            with self._lock:
+                self._workers.pop(name, None)
+            # 无论因为什么结束, 未完成的任务都重新分发或以 WorkerLostError 结束, 不会一直挂起
+            self._requeue(list(inflight.values()), name)
+            conn.close()
+
+
+def _run_task(send, task_id, fn, args, kwargs):
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        message = ("result", task_id, False, e)
+    else:
+        message = ("result", task_id, True, result)
+    try:
+        send(message)
+    except (EOFError, OSError):
+        pass
+    except Exception as e:  # 结果或异常无法pickle
+        send(("result", task_id, False, RuntimeError("unable to send result: {!r}".format(e))))
+
+
+def run_worker(address, authkey=None, slots=1):
+    """
+    启动一个worker, 连接到 `RemoteExecutor` 并执行分发过来的任务, 直到主进程通知退出或断开连接
+
+    任务在 slots 个线程中运行, 计算密集的任务应当每个CPU启动一个 slots=1 的worker
+    """
+    conn = Client(tuple(address), authkey=authkey)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    send(("hello", slots, "{}:{}".format(socket.gethostname(), os.getpid())))
+    _, heartbeat_interval = conn.recv()
+
+    stopped = threading.Event()
+
+    def _heartbeat():
+        while not stopped.wait(heartbeat_interval):
+            try:
+                send(("heartbeat",))
+            except (EOFError, OSError):
+                return
+
+    heartbeat_thread = threading.Thread(target=_heartbeat)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+    pool = ThreadPoolExecutor(slots)
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "task":
+                _, task_id, fn, args, kwargs = message
+                pool.submit(_run_task, send, task_id, fn, args, kwargs)
+            elif message[0] == "stop":
+                break
+    finally:
+        stopped.set()
+        pool.shutdown(wait=True)
+        conn.close()
+
+
+def _parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host, int(port)
+
+
+def _square_after(x, duration=0.0):
+    time.sleep(duration)
+    return x * x
+
+
+def _fail_on_load():
+    raise RuntimeError("cannot unpickle")
+
+
+class _Unloadable(object):
+    """能在worker端pickle, 但在主进程unpickle时出错"""
+
+    def __reduce__(self):
+        return _fail_on_load, ()
+
+
+def _make_unloadable():
+    return _Unloadable()
+
+
+def _start_workers(address, authkey, count, slots=2):
+    import multiprocessing
+    workers = []
+    for _ in range(count):
+        p = multiprocessing.Process(target=run_worker, args=(address, authkey, slots))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+    return workers
+
+
+def _wait_workers(executor, count, timeout=10):
+    deadline = time.time() + timeout
+    while len(executor.workers) < count:
+        assert time.time() < deadline, "workers not connected"
+        time.sleep(0.01)
+
+
+def test_remote_executor():
+    from executor_buffmap import base_buffmap
+
+    # 监听非本机地址时必须有 authkey
+    try:
+        RemoteExecutor(("0.0.0.0", 0))
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert _is_loopback("127.0.0.1") and _is_loopback("::1") and _is_loopback("localhost")
+    assert not _is_loopback("0.0.0.0") and not _is_loopback("example.com")
+
+    authkey = b"test-secret"
+    executor = RemoteExecutor(authkey=authkey, heartbeat_interval=0.1, heartbeat_timeout=0.5)
+    workers = _start_workers(executor.address, authkey, 3)
+    _wait_workers(executor, 3)
+    assert executor._max_workers == 6
+
+    assert executor.submit(_square_after, 3).result(timeout=5) == 9
+    future = executor.submit(int, "x")
+    try:
+        future.result(timeout=5)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    # 运行中杀死一个worker, 它的任务被重新分发
+    results = []
+    for i, x in enumerate(base_buffmap(executor, _square_after, range(60), common_kwargs={"duration": 0.02})):
+        results.append(x)
+        if i == 10:
+            workers[0].terminate()
+    assert sorted(results) == [x * x for x in range(60)]
+    assert executor.lost_workers == 1
+    for p in workers[1:]:
+        p.join(5)
+        assert p.exitcode == 0
+
+    # 结果无法在主进程 unpickle 时, 任务不会一直挂起
+    executor = RemoteExecutor(authkey=authkey, max_retries=1)
+    workers = _start_workers(executor.address, authkey, 2, slots=1)
+    _wait_workers(executor, 2)
+    try:
+        executor.submit(_make_unloadable).result(timeout=10)
+    except WorkerLostError:
+        pass
+    else:
+        assert False
+    executor.shutdown(wait=False)
+    for p in workers:
+        p.join(5)
+    # shutdown 之后不再接受连接
+    time.sleep(0.1)
+    try:
+        socket.create_connection(executor.address, timeout=1).close()
+    except OSError:
+        pass
+    else:
+        assert False, "listener still open after shutdown"
+
+    # 卡住的worker (不再发送心跳) 通过心跳超时发现
+    if hasattr(__import__("signal"), "SIGSTOP"):
+        import signal
+        executor = RemoteExecutor(authkey=authkey, heartbeat_interval=0.1, heartbeat_timeout=0.5)
+        workers = _start_workers(executor.address, authkey, 2, slots=1)
+        _wait_workers(executor, 2)
+        futures = [executor.submit(_square_after, x, 0.1) for x in range(10)]
+        os.kill(workers[0].pid, signal.SIGSTOP)
+        try:
+            assert sorted(f.result(timeout=10) for f in futures) == [x * x for x in range(10)]
+            assert executor.lost_workers == 1
+        finally:
+            workers[0].kill()
+        executor.shutdown(wait=True)
+        workers[1].join(5)
+        assert workers[1].exitcode == 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["worker"]:
+        import argparse
+        parser = argparse.ArgumentParser(description="RemoteExecutor worker")
+        parser.add_argument("command")
+        parser.add_argument("address", help="host:port")
+        parser.add_argument("--slots", type=int, default=1)
+        parser.add_argument("--authkey", required=True)
+        args = parser.parse_args()
+        logging.basicConfig(level=logging.INFO)
+        run_worker(
+            _parse_address(args.address),
+            authkey=args.authkey.encode("utf8"),
+            slots=args.slots,
+        )
+    else:
+        test_remote_executor()
+        print("all tests passed!")
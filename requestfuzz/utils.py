@@ -4,7 +4,10 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from future.builtins import *
 import six
 
-import collections
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
 
 from tldextract import TLDExtract
 
@@ -75,7 +78,7 @@ def make_netloc(host, scheme="http", port=None):
 
 def like_dict(obj):
     """判断一个对象是否像是dict"""
-    if isinstance(obj, (dict, collections.Mapping)):
+    if isinstance(obj, (dict, Mapping)):
         return True
     return hasattr(obj, "__getitem__") and hasattr(obj, "items")
 
@@ -97,7 +100,7 @@ def like_list(obj):
         return True
     elif isinstance(obj, six.string_types):
         return False
-    elif isinstance(obj, collections.Sequence):
+    elif isinstance(obj, Sequence):
         return True
     try:
         return hasattr(obj, "__getitem__") and hasattr(obj, "index")
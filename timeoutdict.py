@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
 # coding=utf-8
 from __future__ import unicode_literals, division
+import sys
 import time
+import copy
+import math
+import functools
+import threading
 import collections
 
-__version__ = (1, 3, 0)
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
+from concurrent.futures import Future
 
-class TimeoutDict(collections.MutableMapping):
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+__version__ = (1, 4, 0)
+
+_monotonic = getattr(time, "monotonic", time.time)
+
+
+class TimeoutDict(MutableMapping):
     """
     >>> import time
     >>> td = TimeoutDict(1)
@@ -38,51 +57,113 @@ class TimeoutDict(collections.MutableMapping):
     >>> td[4]=4
     >>> td[5]=5
     >>> assert len({1, 2, 3} & td.keys()) == 0, td
+    >>> # LRU: 读取会把key移到最后, 超过 max_len 时删除最久没有被读写的
+    >>> td = TimeoutDict(1, max_len=2, lru=True)
+    >>> td.update({1: 1, 2: 2})
+    >>> td[1]
+    1
+    >>> td[3] = 3
+    >>> assert list(td.keys()) == [1, 3]
+    >>> # 按字节数限制大小
+    >>> td = TimeoutDict(1, max_bytes=10, sizer=len, lru=True)
+    >>> td.update({"a": "xxxx", "b": "yyyy"})
+    >>> td["a"]
+    'xxxx'
+    >>> td["c"] = "zzzz"
+    >>> assert sorted(td.keys()) == ["a", "c"] and td.nbytes == 8
     """
     
     # noinspection PyMissingConstructor
-    def __init__(self, max_age, max_len=0, **kwargs):
+    def __init__(self, max_age, max_len=0, lru=False, touch_on_read=False,
+                 max_bytes=0, sizer=None, clock=None, **kwargs):
+        """
+        Args:
+            max_age (float): 写入后多久过期
+            max_len (int): 最大长度, 超过时删除最前面的key, 0为不限制
+            lru (bool): 读取时把key移到最后, 这样超过 max_len/max_bytes 时
+                删除的是最久没有被读写的key, 而不是最早写入的
+            touch_on_read (bool): 读取时重新计算过期时间, 隐含 lru=True
+            max_bytes (int): 所有value的总大小上限, 超过时从最前面开始删除, 0为不限制
+            sizer (callable): 计算value的大小, 默认为 sys.getsizeof
+            clock (CoarseClock): 使用粗粒度时钟代替 time.time(), 过期时间的精度为时钟的 interval
+        """
         assert max_age >= 0
         assert max_len >= 0
+        assert max_bytes >= 0
         
-        self.data = collections.OrderedDict()
-        self.oldest_time = time.time()
         self.max_age = max_age
         self.max_len = max_len
+        self.lru = lru or touch_on_read
+        self.touch_on_read = touch_on_read
+        self.max_bytes = max_bytes
+        self.sizer = sizer or sys.getsizeof
+        self.nbytes = 0
+        self.clock = clock
+        
+        # value 和写入时间分开存放, 不需要为每个entry创建 (时间, value) 的tuple
+        #   使用 CoarseClock 时同一个tick内写入的entry还共用同一个float
+        # data: key -> value, 只有 lru 而读取不刷新过期时间时才需要单独维护读写的顺序
+        # _times: key -> 写入时间, 按写入(touch_on_read 时为读写)的先后排序, 用于检查过期
+        self._times = collections.OrderedDict()
+        if self.lru and not touch_on_read:
+            self.data = collections.OrderedDict()
+            self._order = self.data
+        else:
+            self.data = {}
+            self._order = self._times
+        self._sizes = {} if max_bytes else None
+        self.oldest_time = self._now()
+    
+    def _now(self):
+        return time.time() if self.clock is None else self.clock.now
     
     def oldest_item(self, with_time=False):
-        key, time_value = next(iter(self.data.items()))
-        time_, value = time_value
+        # 按写入时间取最早的, lru 模式下 _order 是访问顺序, 不能用
+        key = next(iter(self._times))
+        value = self.data[key]
         if with_time:
-            return key, value, time_
+            return key, value, self._times[key]
         else:
             return key, value
     
+    def _remove(self, key):
+        value = self.data.pop(key)
+        del self._times[key]
+        if self._sizes is not None:
+            self.nbytes -= self._sizes.pop(key)
+        return value
+    
     def check_expire(self):
-        now = time.time()
+        now = time.time() if self.clock is None else self.clock.now
         if not self.oldest_time \
                 or now - self.oldest_time < self.max_age:
             return 0
         
         del_list = []
-        for key, time_value in self.data.items():  # 从旧往前依次检查
-            if now - time_value[0] > self.max_age:
+        for key, time_ in self._times.items():  # 从旧往前依次检查
+            if now - time_ > self.max_age:
                 del_list.append(key)
             else:
-                self.oldest_time = time_value[0]
+                self.oldest_time = time_
                 break
         else:  # 没有被break, 所有key都被清空, 清零oldest_time
-            self.oldest_time = time.time()
+            self.oldest_time = now
         
         for key in del_list:
-            del self.data[key]
+            self._remove(key)
         
         return len(del_list)
 
     def __getitem__(self, key):
         self.check_expire()
-
-        return self.data[key][1]
+        
+        value = self.data[key]
+        if self.touch_on_read:
+            self._times[key] = self._now()
+            self._times.move_to_end(key)
+        elif self.lru:
+            self.data.move_to_end(key)
+        return value
     
     def __contains__(self, key):
         self.check_expire()
@@ -91,38 +172,976 @@ class TimeoutDict(collections.MutableMapping):
     
     def __delitem__(self, key):
         self.check_expire()
-        del self.data[key]
+        self._remove(key)
     
     def __len__(self):
         self.check_expire()
         return len(self.data)
 
+    def _snapshot(self):
+        # lru 模式下读取会调整 _order 的顺序, 遍历时边读边迭代会报错, 所以返回快照
+        return list(self._order) if self.lru else self._order
+
     def __iter__(self):
         self.check_expire()
-        return iter(self.data)
+        return iter(self._snapshot())
     
     def keys(self):
         self.check_expire()
-        return self.data.keys()
+        if self.lru:
+            return collections.OrderedDict.fromkeys(self._order).keys()
+        return self._order.keys()
     
     def values(self):
         self.check_expire()
-        return (x[1] for x in self.data.values())
+        return (self.data[k] for k in self._snapshot())
     
     def items(self):
         self.check_expire()
-        return ((k, v[1]) for k, v in self.data.items())
+        return ((k, self.data[k]) for k in self._snapshot())
     
     def __setitem__(self, key, item):
-        if self.max_len and len(self.data) == self.max_len:
+        if self._sizes is not None:
+            # 在修改任何状态之前检查大小, 过大时原有的值保持不变
+            size = self.sizer(item)
+            if size > self.max_bytes:
+                raise ValueError("item size {} exceeds max_bytes={}".format(size, self.max_bytes))
+        
+        if key in self.data:
+            # 先删除旧的, 保证按写入时间排序
+            self._remove(key)
+        
+        if self.max_len and len(self.data) >= self.max_len:
             # 若超过最大长度则删除最前面的
-            self.data.popitem(last=False)
-        self.data[key] = (time.time(), item)
-
+            self._remove(next(iter(self._order)))
+        
+        if self._sizes is not None:
+            while self.nbytes + size > self.max_bytes:
+                self._remove(next(iter(self._order)))
+            self._sizes[key] = size
+            self.nbytes += size
+        
+        self.data[key] = item
+        self._times[key] = time.time() if self.clock is None else self.clock.now
+    
+    def clear(self):
+        self.data.clear()
+        self._times.clear()
+        if self._sizes is not None:
+            self._sizes.clear()
+        self.nbytes = 0
+    
     def copy(self):
-        new = self.__class__(self.max_age)
-        new.oldest_time = self.oldest_time
+        new = copy.copy(self)
         new.data = self.data.copy()
+        new._times = self._times.copy()
+        new._order = new.data if self._order is self.data else new._times
+        if self._sizes is not None:
+            new._sizes = self._sizes.copy()
+        return new
 
     def __repr__(self):
-        return "{}<{}>".format(self.__class__.__name__, repr(self.data))
+        return "{}<{}>".format(self.__class__.__name__, repr(dict(self.items())))
+
+
+class CoarseClock(object):
+    """
+    粗粒度的单调时钟, 后台线程每 interval 秒更新一次 `now`
+    
+    读取 `now` 只是一次属性访问, 没有系统调用, 用于调用非常频繁而对精度要求不高的地方,
+      比如 `TimeoutDict(60, clock=CoarseClock())`, 多个dict应当共用同一个时钟,
+      可以使用 `get_coarse_clock()` 得到全局共用的时钟
+    
+    >>> clock = CoarseClock(0.01)
+    >>> t = clock.now
+    >>> time.sleep(0.05)
+    >>> assert 0.02 < clock() - t < 0.2
+    >>> clock.stop()
+    """
+    
+    def __init__(self, interval=0.005, timer=None):
+        self.interval = interval
+        self.timer = timer or _monotonic
+        self.now = self.timer()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="coarse-clock")
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.now = self.timer()
+    
+    def __call__(self):
+        return self.now
+    
+    def stop(self):
+        self._stopped.set()
+
+
+_coarse_clock = None
+_coarse_clock_lock = threading.Lock()
+
+
+def get_coarse_clock():
+    """全局共用的 CoarseClock, 精度为5ms, 第一次调用时启动"""
+    global _coarse_clock
+    if _coarse_clock is None:
+        with _coarse_clock_lock:
+            if _coarse_clock is None:
+                _coarse_clock = CoarseClock()
+    return _coarse_clock
+
+
+def test_lru_timeout_dict():
+    # lru: 读取改变顺序, 但不延长过期时间
+    td = TimeoutDict(0.2, max_len=3, lru=True)
+    td.update({1: 1, 2: 2, 3: 3})
+    time.sleep(0.1)
+    td[4] = 4  # 删除 1
+    assert td[2] == 2
+    assert list(td.keys()) == [3, 4, 2]
+    time.sleep(0.15)
+    assert list(td.keys()) == [4]  # 2 虽然最近被读过, 仍然按写入时间过期
+    
+    # touch_on_read: 读取延长过期时间
+    td = TimeoutDict(0.2, touch_on_read=True)
+    td.update({1: 1, 2: 2})
+    for _ in range(3):
+        time.sleep(0.1)
+        assert td[1] == 1
+    assert list(td.keys()) == [1]
+    
+    # max_bytes
+    td = TimeoutDict(10, max_bytes=100, sizer=len, lru=True)
+    for i in range(10):
+        td[i] = "x" * 20
+        td[0]
+    assert td.nbytes == 100 and sorted(td.keys()) == [0, 6, 7, 8, 9]
+    td[6] = "y" * 60  # 覆盖时先减去旧的大小
+    assert td.nbytes == 100 and sorted(td.keys()) == [0, 6, 9]
+    del td[6]
+    assert td.nbytes == 40
+    for key in ("big", 0):  # 覆盖已有的key时, 原有的值也不受影响
+        try:
+            td[key] = "z" * 101
+        except ValueError:
+            pass
+        else:
+            assert False
+    assert td[0] == "x" * 20 and td.nbytes == 40
+    td2 = td.copy()
+    td2.clear()
+    assert td.nbytes == 40 and len(td) == 2 and td2.nbytes == 0
+    
+    # oldest_item 按写入时间, 不受读取顺序影响
+    td = TimeoutDict(10, lru=True)
+    td.update({1: 1, 2: 2})
+    td[1]
+    assert td.oldest_item() == (1, 1)
+    assert td.oldest_item(with_time=True)[2] == td._times[1]
+    
+    # 遍历时读取不会因为调整顺序而报错
+    for kwargs in ({"lru": True}, {"touch_on_read": True}):
+        td = TimeoutDict(10, **kwargs)
+        td.update({1: 1, 2: 2, 3: 3})
+        assert [td[k] for k in td] == [1, 2, 3]
+        assert [td[k] for k in td.keys()] == [1, 2, 3]
+        assert [td[k] for k, _ in td.items()] == [1, 2, 3]
+        assert list(td.values()) == [1, 2, 3]
+
+
+class WheelTimeoutDict(MutableMapping):
+    """
+    使用分层时间轮的 TimeoutDict, 每个key可以有不同的过期时间
+    
+    `TimeoutDict` 所有key共用一个 max_age, 且每次读取都要检查过期.
+    这里每个key按过期时间放在时间轮的槽中, 时间轮随时间推进, 只处理到期的槽,
+      过期的均摊开销为 O(过期的key数), 与总的key数无关, 没有过期的时候读取是 O(1)
+    
+    时间轮有 4 层, 每层 256 个槽, 最底层每个槽为 resolution 秒 (默认 10ms),
+      上层的槽在下层转完一圈时把其中的key下放到下层. 超出最上层范围的key放在最上层, 到时再重新放置
+    读取时还会检查key的精确过期时间, 所以精度不受 resolution 影响
+    
+    max_len 与 `TimeoutDict` 相同, 超过时删除最早插入的key
+    
+    >>> td = WheelTimeoutDict(1)
+    >>> td.set("cat", "foobar", ttl=0.2)
+    >>> td["dog"] = 42  # 使用默认的 ttl=1
+    >>> assert td["cat"] == "foobar" and td["dog"] == 42
+    >>> assert 0.9 < td.ttl("dog") <= 1
+    >>> time.sleep(0.3)
+    >>> assert "cat" not in td
+    >>> assert td.get("cat", "a") == "a"
+    >>> assert list(td.items()) == [("dog", 42)]
+    >>> assert len(td) == 1
+    >>> td.set("dog", 43, ttl=0.1)  # 重新设置会更新过期时间
+    >>> time.sleep(0.2)
+    >>> assert len(td) == 0
+    >>> td = WheelTimeoutDict(1, max_len=2)
+    >>> td.update({1: 1, 2: 2, 3: 3})
+    >>> assert list(td.keys()) == [2, 3]
+    """
+    
+    BITS = 8
+    SLOTS = 1 << BITS
+    MASK = SLOTS - 1
+    LEVELS = 4
+    
+    # noinspection PyMissingConstructor
+    def __init__(self, default_ttl, max_len=0, resolution=0.01, clock=None):
+        assert default_ttl >= 0
+        assert max_len >= 0
+        assert resolution > 0
+        
+        self.default_ttl = default_ttl
+        self.max_len = max_len
+        self.resolution = resolution
+        self.clock = clock or _monotonic
+        
+        # key -> [value, 过期时间, 所在层, 所在槽]
+        self.data = collections.OrderedDict()
+        self._wheel = [[set() for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self._level_counts = [0] * self.LEVELS
+        self._epoch = self.clock()
+        self._tick = 0  # 已经处理到的tick
+    
+    def _place(self, key, entry, expire_tick):
+        """把key放入时间轮, 调用前 expire_tick 必须大于当前tick"""
+        delta = expire_tick - self._tick
+        level = 0
+        while delta >= 1 << (self.BITS * (level + 1)) and level < self.LEVELS - 1:
+            level += 1
+        if delta >= 1 << (self.BITS * self.LEVELS):
+            # 超出时间轮的范围, 先放在最上层能到达的最远的槽, 到时再重新放置
+            expire_tick = self._tick + (1 << (self.BITS * self.LEVELS)) - 1
+        slot = (expire_tick >> (self.BITS * level)) & self.MASK
+        self._wheel[level][slot].add(key)
+        self._level_counts[level] += 1
+        entry[2] = level
+        entry[3] = slot
+    
+    def _unplace(self, key, entry):
+        self._wheel[entry[2]][entry[3]].discard(key)
+        self._level_counts[entry[2]] -= 1
+    
+    def _expire_tick(self, expire_time):
+        return int(math.ceil((expire_time - self._epoch) / self.resolution))
+    
+    def _process_tick(self):
+        tick = self._tick
+        # 从上往下, 把转到的上层槽中的key下放
+        level = 1
+        while level < self.LEVELS and tick & ((1 << (self.BITS * level)) - 1) == 0:
+            level += 1
+        for level in range(level - 1, 0, -1):
+            slot = self._wheel[level][(tick >> (self.BITS * level)) & self.MASK]
+            if not slot:
+                continue
+            keys = list(slot)
+            slot.clear()
+            self._level_counts[level] -= len(keys)
+            for key in keys:
+                entry = self.data[key]
+                expire_tick = self._expire_tick(entry[1])
+                if expire_tick <= tick:
+                    del self.data[key]
+                else:
+                    self._place(key, entry, expire_tick)
+        
+        slot = self._wheel[0][tick & self.MASK]
+        if slot:
+            self._level_counts[0] -= len(slot)
+            for key in slot:
+                del self.data[key]
+            slot.clear()
+    
+    def expire(self, now=None):
+        """
+        把时间轮推进到当前时间, 删除到期的key
+        
+        没有key的层会被直接跳过, 长时间没有调用也不需要一个一个tick地推进
+        """
+        if now is None:
+            now = self.clock()
+        target = int((now - self._epoch) / self.resolution)
+        if target <= self._tick:
+            return 0
+        before = len(self.data)
+        while self._tick < target:
+            # 找到最低的非空层, 下一个需要处理的tick是这一层的下一个槽的边界
+            for level in range(self.LEVELS):
+                if self._level_counts[level]:
+                    break
+            else:
+                self._tick = target
+                break
+            step = 1 << (self.BITS * level)
+            next_tick = (self._tick | (step - 1)) + 1
+            if next_tick > target:
+                self._tick = target
+                break
+            self._tick = next_tick
+            self._process_tick()
+        return before - len(self.data)
+    
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+        now = self.clock()
+        self.expire(now)
+        
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self._unplace(key, entry)
+        elif self.max_len and len(self.data) >= self.max_len:
+            # 若超过最大长度则删除最早插入的
+            old_key, old_entry = self.data.popitem(last=False)
+            self._unplace(old_key, old_entry)
+        
+        expire_time = now + ttl
+        entry = [value, expire_time, 0, 0]
+        expire_tick = self._expire_tick(expire_time)
+        self.data[key] = entry
+        if expire_tick <= self._tick:
+            # ttl 小于一个tick, 仍然放在下一个tick, 读取时按精确时间判断
+            expire_tick = self._tick + 1
+        self._place(key, entry, expire_tick)
+    
+    __setitem__ = set
+    
+    def _get_entry(self, key):
+        now = self.clock()
+        self.expire(now)
+        entry = self.data[key]
+        if entry[1] <= now:
+            # 在当前tick内已经过期, 还没有被时间轮删除
+            raise KeyError(key)
+        return entry
+    
+    def __getitem__(self, key):
+        return self._get_entry(key)[0]
+    
+    def __contains__(self, key):
+        try:
+            self._get_entry(key)
+        except KeyError:
+            return False
+        return True
+    
+    def ttl(self, key):
+        """key 剩余的存活时间"""
+        return self._get_entry(key)[1] - self.clock()
+    
+    def __delitem__(self, key):
+        # 已经过期的key与不存在的key一样抛出 KeyError
+        entry = self._get_entry(key)
+        del self.data[key]
+        self._unplace(key, entry)
+    
+    def _live_items(self):
+        now = self.clock()
+        self.expire(now)
+        return ((key, entry) for key, entry in self.data.items() if entry[1] > now)
+    
+    def __len__(self):
+        # 精确到tick: 可能包括当前tick内刚过期, 还没有被时间轮删除的key
+        self.expire()
+        return len(self.data)
+    
+    def __iter__(self):
+        return (key for key, _ in self._live_items())
+    
+    def keys(self):
+        return list(self)
+    
+    def values(self):
+        return [entry[0] for _, entry in self._live_items()]
+    
+    def items(self):
+        return [(key, entry[0]) for key, entry in self._live_items()]
+    
+    def __repr__(self):
+        return "{}<{}>".format(self.__class__.__name__, repr(dict(self.items())))
+
+
+class ConcurrentTimeoutDict(MutableMapping):
+    """
+    线程安全的 TimeoutDict, 使用分段锁
+    
+    key 按 hash 分到 shards 个分段中, 每个分段是一个独立的 `TimeoutDict` 和一把锁,
+      不同分段上的读写互不阻塞. 过期在每个分段内惰性进行, 且在该分段的锁内完成,
+      所以其他线程不会看到过期到一半的状态
+    
+    max_len 平均分给每个分段 (向上取整), 超过时删除该分段中最早插入的key
+    
+    len/keys/values/items 依次锁住每个分段得到快照, 不是整个dict在同一时刻的快照
+    
+    >>> td = ConcurrentTimeoutDict(0.5, shards=4)
+    >>> td["cat"] = "foobar"
+    >>> td.update({i: i for i in range(10)})
+    >>> assert td["cat"] == "foobar" and len(td) == 11
+    >>> assert td.setdefault("cat", "x") == "foobar"
+    >>> assert td.pop(3) == 3 and 3 not in td
+    >>> time.sleep(0.6)
+    >>> assert "cat" not in td and len(td) == 0
+    """
+    
+    # noinspection PyMissingConstructor
+    def __init__(self, max_age, max_len=0, shards=16):
+        assert shards >= 1
+        self.max_age = max_age
+        self.max_len = max_len
+        shard_max_len = -(-max_len // shards) if max_len else 0
+        self._shards = [TimeoutDict(max_age, max_len=shard_max_len) for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+    
+    def _shard(self, key):
+        index = hash(key) % len(self._shards)
+        return self._shards[index], self._locks[index]
+    
+    def __getitem__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard[key]
+    
+    def __contains__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            return key in shard
+    
+    def __setitem__(self, key, item):
+        shard, lock = self._shard(key)
+        with lock:
+            shard[key] = item
+    
+    def __delitem__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            del shard[key]
+    
+    def get(self, key, default=None):
+        shard, lock = self._shard(key)
+        with lock:
+            try:
+                return shard[key]
+            except KeyError:
+                return default
+    
+    def setdefault(self, key, default=None):
+        shard, lock = self._shard(key)
+        with lock:
+            try:
+                return shard[key]
+            except KeyError:
+                shard[key] = default
+                return default
+    
+    _marker = object()
+    
+    def pop(self, key, default=_marker):
+        shard, lock = self._shard(key)
+        with lock:
+            try:
+                value = shard[key]
+            except KeyError:
+                if default is self._marker:
+                    raise
+                return default
+            del shard[key]
+            return value
+    
+    def check_expire(self):
+        count = 0
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                count += shard.check_expire()
+        return count
+    
+    def items(self):
+        result = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                result.extend(shard.items())
+        return result
+    
+    def keys(self):
+        return [k for k, _ in self.items()]
+    
+    def values(self):
+        return [v for _, v in self.items()]
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        count = 0
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                count += len(shard)
+        return count
+    
+    def __repr__(self):
+        return "{}<{}>".format(self.__class__.__name__, repr(dict(self.items())))
+
+
+def test_concurrent_timeout_dict():
+    td = ConcurrentTimeoutDict(0.05, max_len=4000, shards=8)
+    errors = []
+    
+    def _worker(n):
+        try:
+            for i in range(20000):
+                key = (n * 7 + i) % 3000
+                if i % 3 == 0:
+                    td[key] = key
+                else:
+                    value = td.get(key)
+                    assert value is None or value == key
+                if i % 1000 == 0:
+                    assert all(k == v for k, v in td.items())
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [threading.Thread(target=_worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors, errors
+    assert len(td) <= 4000
+    time.sleep(0.1)
+    assert len(td) == 0
+
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "stale_hits", "evictions", "currsize"])
+
+
+def _make_key(args, kwargs):
+    if kwargs:
+        return args + (None,) + tuple(sorted(kwargs.items()))
+    return args
+
+
+class _TTLCache(object):
+    def __init__(self, fn, max_age, max_len, stale_while_revalidate, key):
+        self.fn = fn
+        self.max_age = max_age
+        self.make_key = key or _make_key
+        # 过期后仍然保留 stale_while_revalidate 秒, 值为 (value, 新鲜期截止时间)
+        self.cache = TimeoutDict(max_age + stale_while_revalidate, max_len=max_len)
+        self.lock = threading.Lock()
+        self.inflight = {}  # key -> 正在计算的 Future/Task
+        self.hits = self.misses = self.stale_hits = self.evictions = 0
+    
+    def _lookup(self, key):
+        """在锁内调用, 返回 (value, is_fresh), 没有时返回 None"""
+        self.evictions += self.cache.check_expire()
+        item = self.cache.data.get(key)
+        if item is None:
+            return None
+        value, fresh_until = item
+        return value, time.time() < fresh_until
+    
+    def _store(self, key, value):
+        """在锁内调用"""
+        data = self.cache.data
+        if key not in data and self.cache.max_len and len(data) >= self.cache.max_len:
+            self.evictions += 1
+        self.cache[key] = (value, time.time() + self.max_age)
+    
+    def info(self):
+        with self.lock:
+            self.evictions += self.cache.check_expire()
+            return CacheInfo(self.hits, self.misses, self.stale_hits, self.evictions, len(self.cache.data))
+    
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = self.misses = self.stale_hits = self.evictions = 0
+    
+    def _run(self, future, key, args, kwargs):
+        try:
+            value = self.fn(*args, **kwargs)
+        except BaseException as e:
+            with self.lock:
+                self.inflight.pop(key, None)
+            future.set_exception(e)
+        else:
+            with self.lock:
+                self._store(key, value)
+                self.inflight.pop(key, None)
+            future.set_result(value)
+    
+    def call(self, *args, **kwargs):
+        key = self.make_key(args, kwargs)
+        with self.lock:
+            entry = self._lookup(key)
+            if entry is not None and entry[1]:
+                self.hits += 1
+                return entry[0]
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+            if entry is not None:
+                # 返回过期的值, 在后台刷新
+                self.stale_hits += 1
+                if leader:
+                    thread = threading.Thread(target=self._run, args=(future, key, args, kwargs))
+                    thread.daemon = True
+                    thread.start()
+                return entry[0]
+            self.misses += 1
+        if leader:
+            self._run(future, key, args, kwargs)
+        return future.result()
+    
+    def _async_done(self, flight_key, key, task):
+        with self.lock:
+            self.inflight.pop(flight_key, None)
+            # 读取异常, 避免后台刷新失败时出现 "exception was never retrieved"
+            if not task.cancelled() and task.exception() is None:
+                self._store(key, task.result())
+    
+    async def async_call(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        key = self.make_key(args, kwargs)
+        # task 只能在创建它的事件循环中等待, 所以按 (loop, key) 区分
+        flight_key = (loop, key)
+        with self.lock:
+            entry = self._lookup(key)
+            if entry is None or not entry[1]:
+                task = self.inflight.get(flight_key)
+                if task is None:
+                    task = self.inflight[flight_key] = loop.create_task(self.fn(*args, **kwargs))
+                    task.add_done_callback(functools.partial(self._async_done, flight_key, key))
+            if entry is not None:
+                if entry[1]:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                return entry[0]
+            self.misses += 1
+        # shield: 一个调用方被取消不影响其他等待同一个结果的调用方
+        return await asyncio.shield(task)
+
+
+def ttl_cache(max_age, max_len=0, stale_while_revalidate=0, key=None):
+    """
+    基于 `TimeoutDict` 的缓存装饰器, 缓存 max_age 秒
+    
+     - 同一个key的并发调用只会计算一次, 其他调用方等待这一次的结果 (single-flight),
+         计算抛出的异常会传给所有等待的调用方, 异常不会被缓存
+     - stale_while_revalidate > 0 时, 过期后的 stale_while_revalidate 秒内
+         直接返回旧的值, 同时在后台刷新 (普通函数在新线程中, async函数在新task中)
+     - 支持 `async def` 函数, 被装饰后仍是协程函数, 同一事件循环中并发的调用共享同一个task
+     - max_len 与 `TimeoutDict` 相同, 超过时删除最早插入的
+     - key(args, kwargs) 用于自定义缓存的key, 默认由所有参数组成, 参数必须可hash
+    
+    被装饰的函数有以下属性:
+        cache_info(): 返回 CacheInfo(hits, misses, stale_hits, evictions, currsize),
+            evictions 包括过期和超出 max_len 被删除的
+        cache_clear(): 清空缓存和计数
+    
+    >>> calls = []
+    >>> @ttl_cache(0.2)
+    ... def square(x):
+    ...     calls.append(x)
+    ...     return x * x
+    >>> square(3), square(3), square(4)
+    (9, 9, 16)
+    >>> calls
+    [3, 4]
+    >>> square.cache_info()
+    CacheInfo(hits=1, misses=2, stale_hits=0, evictions=0, currsize=2)
+    >>> time.sleep(0.3)
+    >>> square(3), calls
+    (9, [3, 4, 3])
+    """
+    def decorator(fn):
+        cache = _TTLCache(fn, max_age, max_len, stale_while_revalidate, key)
+        if asyncio is not None and asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                return await cache.async_call(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                return cache.call(*args, **kwargs)
+        
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    
+    return decorator
+
+
+def test_ttl_cache():
+    calls = collections.Counter()
+    
+    @ttl_cache(0.3, stale_while_revalidate=0.5)
+    def slow(x):
+        calls[x] += 1
+        time.sleep(0.1)
+        if x < 0:
+            raise ValueError(x)
+        return x * calls[x]
+    
+    # single-flight: 20个线程同时调用只计算一次
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow(2))) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [2] * 20 and calls[2] == 1
+    info = slow.cache_info()
+    assert info.misses == 20 and info.currsize == 1
+    
+    # 异常不缓存
+    for _ in range(2):
+        try:
+            slow(-1)
+        except ValueError:
+            pass
+        else:
+            assert False
+    assert calls[-1] == 2
+    
+    # 过期后先返回旧值, 后台刷新
+    time.sleep(0.35)
+    assert slow(2) == 2
+    assert slow(2) == 2  # 刷新还没有完成, 不会重复刷新
+    time.sleep(0.15)
+    assert calls[2] == 2 and slow(2) == 4
+    assert slow.cache_info().stale_hits == 2
+    
+    # 超过 stale_while_revalidate 后被删除
+    time.sleep(0.9)
+    info = slow.cache_info()
+    assert info.evictions == 1 and info.currsize == 0, info
+    
+    @ttl_cache(10, max_len=2)
+    def ident(x):
+        return x
+    
+    for x in (1, 2, 3, 1):
+        ident(x)
+    assert ident.cache_info() == CacheInfo(hits=0, misses=4, stale_hits=0, evictions=2, currsize=2)
+    ident.cache_clear()
+    assert ident.cache_info().currsize == 0
+    
+    async_calls = collections.Counter()
+    
+    @ttl_cache(0.2, stale_while_revalidate=1)
+    async def afetch(x):
+        async_calls[x] += 1
+        await asyncio.sleep(0.05)
+        return x * async_calls[x]
+    
+    async def _main():
+        # 并发调用共享同一个task
+        assert await asyncio.gather(*[afetch(3) for _ in range(10)]) == [3] * 10
+        assert async_calls[3] == 1 and await afetch(3) == 3
+        
+        # 一个调用方被取消不影响其他调用方
+        waiter = asyncio.ensure_future(afetch(5))
+        other = asyncio.ensure_future(afetch(5))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        assert await other == 5
+        
+        await asyncio.sleep(0.25)
+        assert await afetch(3) == 3  # 过期的值, 后台刷新
+        await asyncio.sleep(0.1)
+        assert await afetch(3) == 6
+        return afetch.cache_info()
+    
+    loop = asyncio.new_event_loop()
+    info = loop.run_until_complete(_main())
+    loop.close()
+    assert info.hits == 2 and info.misses == 12 and info.stale_hits == 1, info
+    assert asyncio.iscoroutinefunction(afetch)
+    
+    # 不同线程的事件循环同时调用, 各自等待自己循环中的task
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(asyncio.run(afetch(7)))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 4 and set(results) <= {7, 14, 21, 28}
+
+
+class _FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+
+def test_wheel_timeout_dict():
+    import random
+    
+    clock = _FakeClock()
+    td = WheelTimeoutDict(10, resolution=0.01, clock=clock)
+    expected = {}
+    rnd = random.Random(1)
+    
+    # 与直接记录过期时间的dict对比, ttl 覆盖了时间轮的每一层
+    for i in range(20000):
+        clock.now += rnd.choice((0, 0.001, 0.013, 0.5, 3, 50))
+        key = rnd.randrange(2000)
+        op = rnd.random()
+        if op < 0.4:
+            ttl = rnd.choice((0.005, 0.05, 1, 10, 100, 3000, 60 * 86400))
+            td.set(key, i, ttl=ttl)
+            expected[key] = (i, clock.now + ttl)
+        elif op < 0.45 and key in expected:
+            if expected[key][1] > clock.now:
+                del td[key]
+            else:
+                try:
+                    del td[key]
+                except KeyError:
+                    pass
+                else:
+                    assert False
+            del expected[key]
+        else:
+            value = expected.get(key)
+            if value is not None and value[1] > clock.now:
+                assert td[key] == value[0]
+            else:
+                assert key not in td
+    
+        if i % 1000 == 0:
+            live = {k: v[0] for k, v in expected.items() if v[1] > clock.now}
+            assert dict(td.items()) == live
+            # 过期的key都已经从时间轮中删除 (最多剩下当前tick内的)
+            assert len(td.data) - len(live) <= sum(
+                1 for v in expected.values() if clock.now - 0.01 < v[1] <= clock.now)
+            assert sum(td._level_counts) == len(td.data)
+            assert len(live) <= len(td) == len(td.data)
+    
+    # 长时间没有访问
+    clock.now += 365 * 86400
+    assert len(td) == 0 and not td.data and sum(td._level_counts) == 0
+
+
+def benchmark_timeoutdict(count=200000, ttl=60):
+    """
+    与 `TimeoutDict` 的对比, 20w个key, 所有key都未过期:
+        TimeoutDict: set 1012k/s, get+contains 1384k/s
+        WheelTimeoutDict: set 354k/s, get+contains 958k/s
+        WheelTimeoutDict mixed ttl: set+get 349k/s, 67479 keys alive
+    
+    相同的 max_age 时 `TimeoutDict` 按插入顺序过期已经足够快,
+      `WheelTimeoutDict` 用于每个key的 ttl 不同的场景, 此时的吞吐与单一 ttl 时相同
+    """
+    import random
+    
+    keys = ["session-{}".format(i) for i in range(count)]
+    rnd = random.Random(1)
+    lookups = [rnd.choice(keys) for _ in range(count)]
+    
+    for cls in (TimeoutDict, WheelTimeoutDict):
+        td = cls(ttl)
+        start = time.time()
+        for key in keys:
+            td[key] = key
+        set_time = time.time() - start
+        
+        start = time.time()
+        for key in lookups:
+            td[key]
+            key in td
+        get_time = time.time() - start
+        
+        print("{}: set {:.0f}k/s, get+contains {:.0f}k/s".format(
+            cls.__name__, count / set_time / 1000, count * 2 / get_time / 1000))
+    
+    # 混合的过期时间, 不断过期
+    clock = _FakeClock()
+    td = WheelTimeoutDict(ttl, clock=clock)
+    ttls = [rnd.choice((1, 10, 60, 600)) for _ in range(count)]
+    start = time.time()
+    for i, key in enumerate(keys):
+        clock.now += 0.001
+        td.set(key, key, ttl=ttls[i])
+        td.get(lookups[i])
+    elapsed = time.time() - start
+    print("WheelTimeoutDict mixed ttl: set+get {:.0f}k/s, {} keys alive".format(
+        count * 2 / elapsed / 1000, len(td.data)))
+
+
+def benchmark_microbench(count=200000, repeat=3, configs=None):
+    """
+    TimeoutDict 各操作的吞吐 (每项取 repeat 次中最快的) 和每个entry占用的内存 (不包括key和value本身)
+    
+    python timeoutdict.py --bench, 20w个key (机器负载波动较大, 吞吐只有相对意义):
+         time.time: contains 1854k/s, expire 1534k/s, get 2147k/s, set 1191k/s, 154 bytes/entry
+            coarse: contains 1799k/s, expire 965k/s, get 2258k/s, set 1108k/s, 130 bytes/entry
+    改为分开存放 value 和写入时间之前为 171 bytes/entry
+    """
+    import tracemalloc
+    
+    keys = ["key-{}".format(i) for i in range(count)]
+    missing = ["missing-{}".format(i) for i in range(count)]
+    value = object()
+    
+    if configs is None:
+        configs = [("time.time", {}), ("coarse", {"clock": get_coarse_clock()})]
+    for name, kwargs in configs:
+        tracemalloc.start()
+        td = TimeoutDict(60, **kwargs)
+        for key in keys:
+            td[key] = value
+        per_entry = tracemalloc.get_traced_memory()[0] / count
+        tracemalloc.stop()
+        
+        timings = collections.defaultdict(list)
+        for _ in range(repeat):
+            td = TimeoutDict(60, **kwargs)
+            start = time.time()
+            for key in keys:
+                td[key] = value
+            timings["set"].append(time.time() - start)
+            
+            start = time.time()
+            for key in keys:
+                td[key]
+            timings["get"].append(time.time() - start)
+            
+            start = time.time()
+            for key in missing:
+                key in td
+            timings["contains"].append(time.time() - start)
+            
+            # 全部过期
+            td.max_age = 0
+            time.sleep(0.02)
+            start = time.time()
+            expired = td.check_expire()
+            timings["expire"].append(time.time() - start)
+            assert expired == count
+        
+        print("{:>10}: {}, {:.0f} bytes/entry".format(name, ", ".join(
+            "{} {:.0f}k/s".format(op, count / min(t) / 1000) for op, t in sorted(timings.items())
+        ), per_entry))
+
+
+if __name__ == '__main__':
+    if "--bench" in sys.argv[1:]:
+        benchmark_microbench()
+        benchmark_timeoutdict()
+    else:
+        import doctest
+        doctest.testmod()
+        test_lru_timeout_dict()
+        test_wheel_timeout_dict()
+        test_concurrent_timeout_dict()
+        test_ttl_cache()
+        print("all tests passed!")
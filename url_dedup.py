@@ -13,10 +13,22 @@ Requirements:
     future
     
     pybloomfiltermmap [可选, 仅在linux下有, 能快很多]
+    bitarray>=2.3 [使用 pybloom-live 并需要 save/load 时]
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 from future.builtins import *
 from future import utils as six
+import os
+import re
+import sys
+import time
+import math
+import mmap
+import json
+import shutil
+import hashlib
+import logging
+import collections
 
 if six.PY3:
     from urllib import parse
@@ -27,29 +39,323 @@ try:
     from pybloomfilter import BloomFilter
 except ImportError:
     from pybloom_live import BloomFilter
+    
+    BLOOM_BACKEND = "pybloom_live"
+else:
+    BLOOM_BACKEND = "pybloomfilter"
+
+logger = logging.getLogger(__name__)
+
+# 可以走快速归一化的url: 小写的 http/https, 非空的netloc,
+#   全部是可打印的ascii字符 (不含空格), netloc中没有 [] (IPv6, urlsplit 会做额外的检查)
+_RE_FAST_URL = re.compile(r"https?://[!\"$-.0->@-Z\\^-~]+(?:[/?#][!-~]*)?\Z")
+# urlencode (quote_plus) 不会改变的字符, 由这些字符组成的key/value不需要重新编码
+_RE_UNRESERVED = re.compile(r"[A-Za-z0-9_.\-~]*\Z")
+_RE_UNRESERVED_QUERY = re.compile(r"[A-Za-z0-9_.\-~=&]*\Z")
+
+# path 中形如id的片段, 可以带一个后缀名, 例如 123.html
+_RE_PATH_SEGMENT = re.compile(
+    r"(?:(?P<uuid>[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})"
+    r"|(?P<hash>[0-9a-fA-F]{64}|[0-9a-fA-F]{40}|[0-9a-fA-F]{32})"
+    r"|(?P<int>[0-9]+)"
+    r"|(?P<hex>(?=[0-9a-fA-F]*[0-9])(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{8,})"
+    r")(?P<ext>\.[A-Za-z0-9]+)?\Z"
+)
+_PATH_PLACEHOLDERS = (("uuid", "{uuid}"), ("hash", "{hash}"), ("int", "{int}"), ("hex", "{hex}"))
+
+# ---------- 以 mmap 文件作为位数组存储的 bloom ----------
+#   _bloom_create(filename, capacity, err_rate)   创建一个新的空bloom
+#   _bloom_dump(bloom, filename)                  把已有的bloom写入文件, 返回以此文件为存储的bloom
+#   _bloom_open(filename, capacity, err_rate, count)  打开之前写入的文件
+#   _bloom_sync(bloom)                            把内存中修改过的页写回文件
+if BLOOM_BACKEND == "pybloomfilter":
+    # pybloomfilter 本身就支持以 mmap 文件作为存储
+    def _bloom_filename(bloom):
+        try:
+            name = bloom.filename
+        except NotImplementedError:  # 内存中的bloom
+            return None
+        if isinstance(name, bytes):
+            name = name.decode(sys.getfilesystemencoding())
+        return os.path.abspath(name)
+    
+    
+    def _bloom_create(filename, capacity, err_rate):
+        return BloomFilter(capacity, err_rate, filename)
+    
+    
+    def _bloom_dump(bloom, filename):
+        if _bloom_filename(bloom) == os.path.abspath(filename):
+            bloom.sync()
+            return bloom
+        
+        # 内存中的 pybloomfilter 无法直接 copy 到文件,
+        #   所以先用相同的 hash_seeds 创建一个空的文件bloom, 再把位数组写到文件末尾的数据区
+        data = bloom.data_array
+        if os.path.exists(filename):
+            os.remove(filename)
+        BloomFilter(bloom.capacity, bloom.error_rate, filename,
+                    hash_seeds=list(bloom.hash_seeds)).close()
+        with open(filename, "r+b") as fp:
+            mm = mmap.mmap(fp.fileno(), 0)
+            try:
+                mm[len(mm) - len(data):] = data
+                mm.flush()
+            finally:
+                mm.close()
+        
+        return BloomFilter.open(filename)
+    
+    
+    def _bloom_open(filename, capacity, err_rate, count):
+        bloom = BloomFilter.open(filename)
+        if bloom.capacity != capacity or bloom.error_rate != err_rate:
+            raise ValueError("bloom file {} does not match capacity={} err_rate={}".format(
+                filename, capacity, err_rate))
+        return bloom
+    
+    
+    def _bloom_sync(bloom):
+        bloom.sync()
+
+else:
+    def _bloom_filename(bloom):
+        return getattr(bloom, "_mmap_filename", None)
+    
+    
+    def _bloom_mmap(bloom, filename):
+        """把 bloom 的位数组替换为 filename 的 mmap"""
+        import bitarray
+        
+        with open(filename, "r+b") as fp:
+            mm = mmap.mmap(fp.fileno(), 0)
+        if len(mm) * 8 < bloom.num_bits:
+            mm.close()
+            raise ValueError("bloom file {} is too small ({} bytes)".format(filename, len(mm)))
+        
+        bloom.bitarray = bitarray.bitarray(buffer=mm, endian="little")
+        bloom._mmap = mm
+        bloom._mmap_filename = os.path.abspath(filename)
+        return bloom
+    
+    
+    def _bloom_create(filename, capacity, err_rate):
+        bloom = _bloom_setup(capacity, err_rate, 0)
+        with open(filename, "wb") as fp:
+            fp.truncate((bloom.num_bits + 7) // 8)  # 稀疏文件, 全0
+        return _bloom_mmap(bloom, filename)
+    
+    
+    def _bloom_dump(bloom, filename):
+        if _bloom_filename(bloom) == os.path.abspath(filename):
+            bloom._mmap.flush()
+            return bloom
+        
+        with open(filename, "wb") as fp:
+            fp.write(bloom.bitarray.tobytes())
+        return _bloom_mmap(bloom, filename)
+    
+    
+    def _bloom_setup(capacity, err_rate, count):
+        """
+        不分配位数组地构造一个 pybloom_live.BloomFilter,
+          参数的计算方式与 pybloom_live.BloomFilter.__init__ 相同
+        """
+        num_slices = int(math.ceil(math.log(1.0 / err_rate, 2)))
+        bits_per_slice = int(math.ceil(
+            (capacity * abs(math.log(err_rate))) /
+            (num_slices * (math.log(2) ** 2))))
+        bloom = BloomFilter.__new__(BloomFilter)
+        bloom._setup(err_rate, num_slices, bits_per_slice, capacity, count)
+        return bloom
+    
+    
+    def _bloom_open(filename, capacity, err_rate, count):
+        return _bloom_mmap(_bloom_setup(capacity, err_rate, count), filename)
+    
+    
+    def _bloom_sync(bloom):
+        bloom._mmap.flush()
+
 
+def _bloom_num_hashes(bloom):
+    # pybloomfilter 叫 num_hashes, pybloom_live 叫 num_slices
+    return getattr(bloom, "num_hashes", None) or bloom.num_slices
 
-class UrlDedup(object):
+
+def _bloom_estimated_fpr(bloom, count):
     """
-    带有归一化的 url 去重功能
+    根据已插入的元素数量估算 bloom 当前的误报率
     
-    白名单和黑名单:
-        会保留白名单中参数的value, 例如 "action=put" 在常规情况下会变成 action=
-          而在白名单内的, 则不会被移除value, 即 "action=put" 会完整保留
-        黑名单中的参数将会被丢弃
+    p = (1 - e^(-kn/m))^k
+    """
+    k = _bloom_num_hashes(bloom)
+    return (1.0 - math.exp(-k * count / bloom.num_bits)) ** k
+
+
+class ScalableBloomFilter(object):
+    """
+    可自动扩容的 bloom filter
+    
+    当前的子filter装满(达到其capacity)后, 追加一个容量更大(x growth),
+      误报率更低(x tightening)的子filter, 之后的新元素都写入新的子filter.
+    各子filter的误报率是一个等比数列, 所以整体误报率始终不超过 err_rate
+    
+    与 pybloom_live.ScalableBloomFilter 的思路相同,
+      但是可以搭配任意一种后端使用, 并且会统计各子filter的元素数量
     
     Examples:
-        >>> ud = UrlDedup()
-        >>> ud.occurs("http://cat.com/foo")
+        >>> sbf = ScalableBloomFilter(capacity=1000, err_rate=0.001)
+        >>> sbf.add("cat")
         False
-        >>> ud.occurs("http://cat.com/foo") # 第二次出现返回 True
+        >>> sbf.add("cat")
         True
-        >>> ud.occurs("http://cat.com/foo?id=1") # 没出现过的参数
-        False
-        >>> ud.occurs("http://cat.com/foo?id=233") # 参数key相同
+        >>> "cat" in sbf
+        True
+        >>> for i in range(5000): _ = sbf.add(str(i))
+        >>> len(sbf.filters) > 1
         True
+    """
     
-    500w, err=0.001 的情况下, 占用内存大约 8MB
+    def __init__(self, capacity=5000000, err_rate=0.001, growth=2, tightening=0.5):
+        assert capacity > 0
+        assert 0 < err_rate < 1
+        assert growth >= 1
+        assert 0 < tightening < 1
+        
+        self.initial_capacity = capacity
+        self.err_rate = err_rate
+        self.growth = growth
+        self.tightening = tightening
+        
+        self.filters = []
+        self.capacities = []
+        self.err_rates = []
+        self.counts = []
+        self.path = None  # 调用 `save` 以后, 子filter都以mmap文件的形式存放在这个目录
+        self._add_filter()
+    
+    def _filter_filename(self, index, path=None):
+        return os.path.join(path or self.path, "bloom_{}.bits".format(index))
+    
+    def _create_filter(self, capacity, err_rate):
+        if self.path is None:
+            return BloomFilter(capacity, err_rate)
+        else:
+            return _bloom_create(self._filter_filename(len(self.filters)), capacity, err_rate)
+    
+    def _add_filter(self):
+        if not self.filters:
+            capacity = self.initial_capacity
+            # err_rate * (1 + r + r^2 + ...) * (1 - r) == err_rate
+            err_rate = self.err_rate * (1 - self.tightening)
+        else:
+            capacity = int(self.capacities[-1] * self.growth)
+            err_rate = self.err_rates[-1] * self.tightening
+            logger.info("bloom filter #%d is full (%d items), scaling up to capacity=%d err_rate=%g",
+                        len(self.filters) - 1, self.counts[-1], capacity, err_rate)
+        
+        self.filters.append(self._create_filter(capacity, err_rate))
+        self.capacities.append(capacity)
+        self.err_rates.append(err_rate)
+        self.counts.append(0)
+    
+    def add(self, key):
+        """
+        Returns:
+            bool: 是否已经存在
+        """
+        if len(self.filters) > 1:
+            for bloom in self.filters[:-1]:
+                if key in bloom:
+                    return True
+        
+        if self.filters[-1].add(key):
+            return True
+        
+        self.counts[-1] += 1
+        if self.counts[-1] >= self.capacities[-1]:
+            self._add_filter()
+        return False
+    
+    def __contains__(self, key):
+        for bloom in self.filters:
+            if key in bloom:
+                return True
+        return False
+    
+    def __len__(self):
+        return sum(self.counts)
+    
+    @property
+    def capacity(self):
+        return sum(self.capacities)
+    
+    @property
+    def fill_ratio(self):
+        """当前正在写入的子filter的填充率"""
+        return self.counts[-1] / self.capacities[-1]
+    
+    @property
+    def estimated_fpr(self):
+        """整体的估算误报率, 任意一个子filter误报即为误报"""
+        miss = 1.0
+        for bloom, count in zip(self.filters, self.counts):
+            miss *= 1.0 - _bloom_estimated_fpr(bloom, count)
+        return 1.0 - miss
+    
+    def save(self, path):
+        """
+        把各个子filter写入 path 目录, 并改为直接以这些文件的mmap作为存储,
+          之后扩容出来的子filter也会直接创建在该目录下
+        
+        再次保存到同一目录时只需要把修改过的页写回文件
+        
+        Returns:
+            list[dict]: 各子filter的信息, 用于 `open`
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for index, bloom in enumerate(self.filters):
+            self.filters[index] = _bloom_dump(bloom, self._filter_filename(index, path))
+        self.path = path
+        
+        return [
+            {"file": os.path.basename(self._filter_filename(index)),
+             "capacity": capacity, "err_rate": err_rate, "count": count}
+            for index, (capacity, err_rate, count)
+            in enumerate(zip(self.capacities, self.err_rates, self.counts))
+        ]
+    
+    @classmethod
+    def open(cls, path, filters, growth=2, tightening=0.5):
+        """打开 `save` 保存的子filter, filters 即 `save` 的返回值"""
+        self = cls.__new__(cls)
+        self.initial_capacity = filters[0]["capacity"]
+        self.err_rate = filters[0]["err_rate"] / (1 - tightening)
+        self.growth = growth
+        self.tightening = tightening
+        self.path = path
+        
+        self.filters = []
+        self.capacities = []
+        self.err_rates = []
+        self.counts = []
+        for info in filters:
+            self.filters.append(_bloom_open(
+                os.path.join(path, info["file"]), info["capacity"], info["err_rate"], info["count"]))
+            self.capacities.append(info["capacity"])
+            self.err_rates.append(info["err_rate"])
+            self.counts.append(info["count"])
+        return self
+
+
+class UrlNormalizer(object):
+    """
+    url 的归一化和 path 模板, 以及基于 `occurs`/`occurs_many` 的通用接口,
+      由 `UrlDedup` 和 `HostPartitionedDedup` 共用, 子类实现 occurs/occurs_many
+    
+    白名单/黑名单和 path_template 的说明见 `UrlDedup`
     """
     
     WHITELIST = frozenset(["action", "Action", "method"])
@@ -59,17 +365,21 @@ class UrlDedup(object):
         '_'
     ])
     
-    def __init__(self, capacity=5000000, err_rate=0.001,
-                 whitelist=WHITELIST, blacklist=BLACKLIST,
-                 ):
-        self.bloom = BloomFilter(capacity, err_rate)
+    # template_hits 最多保留的模板数, 超过两倍时只保留命中最多的这么多个
+    MAX_TEMPLATES = 10000
+    
+    def __init__(self, whitelist=WHITELIST, blacklist=BLACKLIST, path_template=False):
         self.whitelist = whitelist
         self.blacklist = blacklist
+        self.path_template = path_template
+        self.template_hits = collections.Counter()
     
-    def _normalize(self, url):
+    def _normalize(self, url, count_template=False):
         """
         将url转换为可用于bloom的形式
         
+        count_template=True 时把path模板的命中计入 `template_hits`, 只在写入时使用
+        
         会去掉query中的 value, 排序key, 并移除 fragment
         
         Examples:
@@ -94,6 +404,153 @@ class UrlDedup(object):
                 http://cat.com/foo?action=put&spm=12345
                 --> http://cat.com/foo?action=put
         """
+        if not isinstance(url, six.text_type):
+            normalized_url = self._normalize_slow(url)
+        else:
+            normalized_url = self._normalize_fast(url)
+            if normalized_url is None:
+                normalized_url = self._normalize_slow(url)
+        
+        if self.path_template:
+            normalized_url = self._template_path(normalized_url, count_template)
+        return normalized_url
+    
+    def _template_path(self, url, count=False):
+        """
+        把path中形如id的片段替换为占位符, count=True 时记录模板的命中次数
+        
+        bytes 的url按 latin-1 解码后处理, 再编码回 bytes
+        
+        Examples:
+            http://cat.com/item/123?id=   -->  http://cat.com/item/{int}?id=
+            http://cat.com/u/1f3a9c2e7b/1.html  -->  http://cat.com/u/{hex}/{int}.html
+        """
+        if not isinstance(url, six.text_type):
+            return self._template_path(url.decode("latin-1"), count).encode("latin-1")
+        
+        netloc_pos = url.find("://")
+        if netloc_pos == -1:
+            return url
+        path_start = url.find("/", netloc_pos + 3)
+        if path_start == -1:
+            return url
+        
+        path_end = len(url)
+        for char in "?#":
+            pos = url.find(char, path_start)
+            if pos != -1 and pos < path_end:
+                path_end = pos
+        
+        segments = url[path_start:path_end].split("/")
+        templated = False
+        for index, segment in enumerate(segments):
+            if not segment:
+                continue
+            m = _RE_PATH_SEGMENT.match(segment)
+            if m is None:
+                continue
+            for group, placeholder in _PATH_PLACEHOLDERS:
+                if m.group(group) is not None:
+                    segments[index] = placeholder + (m.group("ext") or "")
+                    templated = True
+                    break
+        
+        if not templated:
+            return url
+        
+        template = url[:path_start] + "/".join(segments)
+        if count:
+            self._count_template(template)
+        return template + url[path_end:]
+    
+    def _count_template(self, template):
+        """
+        记录模板的命中次数, 模板数超过 MAX_TEMPLATES 的两倍时只保留命中最多的 MAX_TEMPLATES 个,
+          均摊开销很低, 内存不会随着host数量无限增长, 代价是命中较少的模板计数会被清零
+        """
+        hits = self.template_hits
+        hits[template] += 1
+        if len(hits) > self.MAX_TEMPLATES * 2:
+            self.template_hits = collections.Counter(dict(hits.most_common(self.MAX_TEMPLATES)))
+    
+    def top_templates(self, n=10):
+        """
+        命中次数最多的n个path模板 (只统计写入的url), n 不超过 MAX_TEMPLATES 时结果是准确的近似
+        
+        Returns:
+            list[tuple[str, int]]: [(模板, 命中次数), ...]
+        """
+        return self.template_hits.most_common(n)
+    
+    def _normalize_fast(self, url):
+        """
+        `_normalize` 的快速实现, 只扫描一遍字符串, 不经过 urllib.parse
+        
+        仅处理常见的、结果必定与 `_normalize_slow` 完全一致的url:
+          scheme 为小写的 http/https, 全部为可打印的ascii字符,
+          并且query的key (以及白名单参数的value) 不包含需要编码/解码的字符
+        
+        Returns:
+            str|None: 归一化后的url, 不能走快速路径时返回 None
+        """
+        if _RE_FAST_URL.match(url) is None:
+            return None
+        
+        hash_pos = url.find("#")
+        if hash_pos == -1:
+            body = url
+            has_fragment = False
+        else:
+            body = url[:hash_pos]
+            has_fragment = hash_pos != len(url) - 1
+        
+        query_pos = body.find("?")
+        if query_pos == -1:
+            prefix = body
+            query = ""
+        else:
+            prefix = body[:query_pos]
+            query = body[query_pos + 1:]
+        
+        if not query:
+            # 与 `_normalize_slow` 一致: 没有query也没有fragment时原样返回, 否则丢弃 "?#..."
+            return prefix if has_fragment else url
+        
+        whitelist = self.whitelist
+        query_is_unreserved = _RE_UNRESERVED_QUERY.match(query) is not None
+        
+        pairs = []
+        for segment in query.split("&"):
+            if not segment:
+                continue
+            key, _, value = segment.partition("=")
+            # 需要解码/编码的 key 或 白名单参数的value, 交给慢速路径处理
+            if query_is_unreserved:
+                # 此时只有value中可能还有一个需要编码的 "="
+                if "=" in value and key in whitelist:
+                    return None
+            elif _RE_UNRESERVED.match(key) is None \
+                    or key in whitelist and _RE_UNRESERVED.match(value) is None:
+                return None
+            pairs.append((key, value))
+        pairs.sort()
+        
+        blacklist = self.blacklist
+        normalized_query = "&".join(
+            key + "=" + value if key in whitelist else key + "="
+            for key, value in pairs
+            if key not in blacklist
+        )
+        
+        if normalized_query:
+            return prefix + "?" + normalized_query
+        else:
+            return prefix
+    
+    def _normalize_slow(self, url):
+        """
+        `_normalize` 基于 urllib.parse 的完整实现, 可以处理任意url
+        """
         try:
             _sp = parse.urlsplit(url)
         except:  # 解析url失败, 原样返回
@@ -106,11 +563,27 @@ class UrlDedup(object):
                 # 移除fragment
                 return parse.urlunsplit((_sp.scheme, _sp.netloc, _sp.path, "", ""))
         
-        # ---- 处理query -----
+        normalized_query = self._normalize_query(_sp.query)
+        if normalized_query is None:
+            return url
+        
+        return parse.urlunsplit((_sp.scheme, _sp.netloc, _sp.path, normalized_query, ""))
+    
+    def _normalize_query(self, query, encode_cache=None):
+        """
+        归一化 query 部分: 排序key, 丢弃黑名单参数, 移除非白名单参数的value
+        
+        Args:
+            encode_cache (dict): 可选, 缓存 urlencode 的结果,
+                由于value基本都被抹掉了, 大量url归一化后的参数完全相同
+        
+        Returns:
+            str|None: 归一化后的 query, 解析失败时返回 None
+        """
         try:
-            query = parse.parse_qsl(_sp.query, True)
+            query = parse.parse_qsl(query, True)
         except:
-            return url
+            return None
         query.sort()
         
         normalized_query = []
@@ -124,9 +597,279 @@ class UrlDedup(object):
                 value = ""
             normalized_query.append((key, value))
         
-        normalized_query = parse.urlencode(normalized_query)
+        if encode_cache is None:
+            return parse.urlencode(normalized_query)
         
-        return parse.urlunsplit((_sp.scheme, _sp.netloc, _sp.path, normalized_query, ""))
+        normalized_query = tuple(normalized_query)
+        try:
+            return encode_cache[normalized_query]
+        except KeyError:
+            encoded = encode_cache[normalized_query] = parse.urlencode(normalized_query)
+            return encoded
+    
+    def _normalize_many(self, urls, count_template=False):
+        """
+        `_normalize` 的批量版本, 结果与逐个调用 `_normalize` 完全一致
+        
+        大部分url会走 `_normalize_fast`, 对于剩下需要完整解析的url,
+          同一批url中往往有大量重复的 scheme/netloc/path 前缀,
+          以及完全相同的 query (例如翻页, 重复链接), 归一化后相同的参数列表,
+          这里在一个批次内缓存这些已经解析/拼接过的片段, 避免重复计算
+        
+        Returns:
+            list: 与输入一一对应的归一化结果
+        """
+        urlsplit = parse.urlsplit
+        urlunsplit = parse.urlunsplit
+        normalize_query = self._normalize_query
+        
+        prefixes = {}  # (scheme, netloc, path) --> "scheme://netloc/path"
+        queries = {}  # 原始query --> 归一化后的query
+        encode_cache = {}  # 归一化后的参数列表 --> urlencode 结果
+        results = []
+        append = results.append
+        
+        normalize_fast = self._normalize_fast
+        
+        for url in urls:
+            if not isinstance(url, six.text_type):  # bytes 走常规路径
+                append(self._normalize_slow(url))
+                continue
+            
+            normalized_url = normalize_fast(url)
+            if normalized_url is not None:
+                append(normalized_url)
+                continue
+            
+            try:
+                _sp = urlsplit(url)
+            except:  # 解析url失败, 原样返回
+                append(url)
+                continue
+            
+            if _sp.query:
+                try:
+                    query = queries[_sp.query]
+                except KeyError:
+                    query = queries[_sp.query] = normalize_query(_sp.query, encode_cache)
+                if query is None:
+                    append(url)
+                    continue
+            elif not _sp.fragment:
+                append(url)
+                continue
+            else:
+                query = ""
+            
+            prefix_key = (_sp.scheme, _sp.netloc, _sp.path)
+            try:
+                prefix = prefixes[prefix_key]
+            except KeyError:
+                prefix = prefixes[prefix_key] = urlunsplit(prefix_key + ("", ""))
+            
+            # 等价于 urlunsplit((scheme, netloc, path, query, ""))
+            append(prefix + "?" + query if query else prefix)
+        
+        if self.path_template:
+            template_path = self._template_path
+            results = [template_path(x, count_template) for x in results]
+        return results
+    
+    def _key(self, url, count_template=False):
+        """归一化url, 并编码为写入bloom的key"""
+        normalized_url = self._normalize(url, count_template)
+        if isinstance(url, six.text_type):
+            normalized_url = normalized_url.encode("UTF-8")
+        return normalized_url
+    
+    def _keys(self, urls, count_template=False):
+        """`_key` 的批量版本"""
+        return [
+            x.encode("UTF-8") if isinstance(x, six.text_type) else x
+            for x in self._normalize_many(urls, count_template)
+        ]
+    
+    def contains_many(self, urls):
+        return self.occurs_many(urls, auto_add=False)
+    
+    def __contains__(self, url):
+        return self.occurs(url, auto_add=False)
+    
+    def add(self, url):
+        return self.occurs(url)
+
+
+class UrlDedup(UrlNormalizer):
+    """
+    带有归一化的 url 去重功能
+    
+    白名单和黑名单:
+        会保留白名单中参数的value, 例如 "action=put" 在常规情况下会变成 action=
+          而在白名单内的, 则不会被移除value, 即 "action=put" 会完整保留
+        黑名单中的参数将会被丢弃
+    
+    Examples:
+        >>> ud = UrlDedup()
+        >>> ud.occurs("http://cat.com/foo")
+        False
+        >>> ud.occurs("http://cat.com/foo") # 第二次出现返回 True
+        True
+        >>> ud.occurs("http://cat.com/foo?id=1") # 没出现过的参数
+        False
+        >>> ud.occurs("http://cat.com/foo?id=233") # 参数key相同
+        True
+    
+    500w, err=0.001 的情况下, 占用内存大约 8MB
+    
+    长时间运行时插入的url数量可能超过 capacity, 此时误报率会迅速上升,
+      可以传入 scalable=True, 在装满后自动追加更大的 bloom (见 `ScalableBloomFilter`),
+      这时 capacity 只是初始容量, 可以设得小一些以节约内存.
+      通过 `fill_ratio` 和 `estimated_fpr` 可以观察当前的状态
+    
+    path 指向已经 `save` 过的目录时直接从中恢复, 白名单/黑名单/path_template 等设置
+      都使用保存时的值, 忽略构造函数中传入的值
+    
+    path_template=True 时, path中形如id的片段 (纯数字, uuid, hash, 较长的hex) 会被替换为占位符,
+      例如 /item/123 和 /item/124 都会变成 /item/{int}, 被认为是相同的url.
+      写入时每个模板被命中的次数记录在 `template_hits` 中, 可以用 `top_templates` 查看,
+      模板数量超过 MAX_TEMPLATES 的两倍时只保留命中最多的 MAX_TEMPLATES 个
+    """
+    
+    def __init__(self, capacity=5000000, err_rate=0.001,
+                 whitelist=UrlNormalizer.WHITELIST, blacklist=UrlNormalizer.BLACKLIST,
+                 scalable=False, path=None, path_template=False,
+                 ):
+        UrlNormalizer.__init__(self, whitelist, blacklist, path_template)
+        self.path = None
+        # 固定容量模式下 已插入数量 = _count_base + len(bloom)
+        #   pybloomfilter 在从内存写入文件后计数会被清零, 需要额外记录
+        self._count_base = 0
+        
+        if path is not None and os.path.exists(os.path.join(path, "meta.json")):
+            self._load_bloom(path)
+        else:
+            self.scalable = scalable
+            if scalable:
+                self.bloom = ScalableBloomFilter(capacity, err_rate)
+            else:
+                self.bloom = BloomFilter(capacity, err_rate)
+            
+            if path is not None:
+                self.save(path)
+    
+    def save(self, path=None):
+        """
+        将去重状态保存到 path 目录, 可以用 `UrlDedup.load` 恢复
+        
+        保存后 bloom 的位数组直接以该目录下文件的 mmap 作为存储,
+          所以第一次保存会完整写一遍, 之后再保存到同一目录 (可以省略path)
+          只需要把修改过的页写回文件并重写一个很小的 meta.json,
+          开销很低, 可以每隔几秒做一次 checkpoint
+        """
+        if path is None:
+            path = self.path
+            if path is None:
+                raise ValueError("path is required for the first save")
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        
+        if self.scalable:
+            filters = self.bloom.save(path)
+            capacity, err_rate = self.bloom.initial_capacity, self.bloom.err_rate
+        else:
+            count = self._count()
+            self.bloom = _bloom_dump(self.bloom, os.path.join(path, "bloom_0.bits"))
+            self._count_base = count - len(self.bloom)
+            capacity, err_rate = self.bloom.capacity, self.bloom.error_rate
+            filters = [{"file": "bloom_0.bits", "capacity": capacity, "err_rate": err_rate, "count": count}]
+        
+        meta = {
+            "backend": BLOOM_BACKEND,
+            "capacity": capacity,
+            "err_rate": err_rate,
+            "whitelist": sorted(self.whitelist),
+            "blacklist": sorted(self.blacklist),
+            "scalable": self.scalable,
+            "path_template": self.path_template,
+            "filters": filters,
+        }
+        if self.scalable:
+            meta["growth"] = self.bloom.growth
+            meta["tightening"] = self.bloom.tightening
+        
+        # 先写临时文件再替换, 避免写到一半崩溃导致 meta.json 损坏
+        meta_file = os.path.join(path, "meta.json")
+        with open(meta_file + ".tmp", "w") as fp:
+            json.dump(meta, fp, indent=4)
+        getattr(os, "replace", os.rename)(meta_file + ".tmp", meta_file)
+        
+        self.path = path
+    
+    @staticmethod
+    def _read_meta(path):
+        with open(os.path.join(path, "meta.json")) as fp:
+            meta = json.load(fp)
+        if meta["backend"] != BLOOM_BACKEND:
+            raise ValueError("{} was saved with {}, but current bloom backend is {}".format(
+                path, meta["backend"], BLOOM_BACKEND))
+        return meta
+    
+    def _load_bloom(self, path):
+        path = os.path.abspath(path)
+        meta = self._read_meta(path)
+        
+        # 归一化的设置必须与保存时一致, 否则同一个url会得到不同的key
+        self.whitelist = frozenset(meta["whitelist"])
+        self.blacklist = frozenset(meta["blacklist"])
+        self.path_template = meta.get("path_template", False)
+        self.scalable = meta["scalable"]
+        if self.scalable:
+            self.bloom = ScalableBloomFilter.open(
+                path, meta["filters"], meta["growth"], meta["tightening"])
+        else:
+            info = meta["filters"][0]
+            self.bloom = _bloom_open(
+                os.path.join(path, info["file"]), info["capacity"], info["err_rate"], info["count"])
+            self._count_base = info["count"] - len(self.bloom)
+        self.path = path
+    
+    @classmethod
+    def load(cls, path):
+        """
+        从 `save` 保存的目录恢复, 位数组直接 mmap 打开, 不需要重新插入
+        
+        恢复后的修改同样直接写在该目录的文件上, 继续调用 `save()` 即可做 checkpoint
+        """
+        meta = cls._read_meta(path)
+        return cls(
+            capacity=meta["capacity"], err_rate=meta["err_rate"],
+            whitelist=frozenset(meta["whitelist"]), blacklist=frozenset(meta["blacklist"]),
+            scalable=meta["scalable"], path=path,
+            path_template=meta.get("path_template", False),
+        )
+    
+    @property
+    def fill_ratio(self):
+        """
+        bloom的填充率 (已插入数量/容量), scalable 模式下为当前子filter的填充率
+        
+        超过 1 以后误报率会迅速上升
+        """
+        if self.scalable:
+            return self.bloom.fill_ratio
+        return self._count() / self.bloom.capacity
+    
+    @property
+    def estimated_fpr(self):
+        """根据已插入的数量估算的当前误报率"""
+        if self.scalable:
+            return self.bloom.estimated_fpr
+        return _bloom_estimated_fpr(self.bloom, self._count())
+    
+    def _count(self):
+        """固定容量模式下已插入的数量"""
+        return self._count_base + len(self.bloom)
     
     def occurs(self, url, auto_add=True):
         """
@@ -138,20 +881,497 @@ class UrlDedup(object):
         Returns:
             bool: 此url是否出现过
         """
-        normalized_url = self._normalize(url)
-        if isinstance(url, six.text_type):
-            normalized_url = normalized_url.encode("UTF-8")
+        key = self._key(url, count_template=auto_add)
         
         if auto_add:
-            return self.bloom.add(normalized_url)
+            return self.bloom.add(key)
         else:
-            return normalized_url in self.bloom
+            return key in self.bloom
     
-    def __contains__(self, url):
-        return self.occurs(url, auto_add=False)
+    def occurs_many(self, urls, auto_add=True):
+        """
+        批量版本的 `occurs`, 一次性归一化整批url, 然后批量写入bloom
+        
+        结果与按顺序逐个调用 `occurs` 完全一致,
+          即同一批次中后出现的重复url也会返回 True
+        
+        Returns:
+            list[bool]: 与输入一一对应, 每个url是否出现过
+        """
+        keys = self._keys(urls, count_template=auto_add)
+        
+        if auto_add:
+            add = self.bloom.add
+            return [add(x) for x in keys]
+        else:
+            bloom = self.bloom
+            return [x in bloom for x in keys]
     
-    def add(self, url):
-        return self.occurs(url)
+class SharedUrlDedup(UrlDedup):
+    """
+    可以在多个进程之间共享的 UrlDedup
+    
+    bloom的位数组放在共享内存 (默认为 /dev/shm 下的 mmap 文件) 中,
+      所有进程看到的是同一份位数组, 不会因为每个进程各有一份私有的bloom而漏掉跨进程的重复,
+      内存占用也不会随进程数成倍增长 (500w, err=0.001 时所有进程合计约 8MB)
+    
+    写入(occurs)在一把进程间的锁内完成, 即 "检查并设置" 是原子的,
+      多个进程同时 occurs 同一个url时, 只有一个会得到 False.
+      只读的查询 (`in`, contains_many) 不加锁
+    
+    和 multiprocessing.Lock 一样, 只能在创建子进程时传递给子进程 (继承),
+      例如作为 Process 的参数, 或 ProcessPoolExecutor/Pool 的 initializer 参数,
+      不能通过 executor.submit 的参数传递.
+      如果子进程不是用默认的方式启动的, 需要传入相同的 mp_context,
+      例如 mp_context=multiprocessing.get_context("spawn")
+    
+    Examples:
+        >>> import multiprocessing
+        >>> ud = SharedUrlDedup(capacity=10000)
+        >>> p = multiprocessing.Process(target=ud.occurs, args=("http://cat.com/foo",))
+        >>> p.start(); p.join()
+        >>> ud.occurs("http://cat.com/foo")  # 子进程中写入的url
+        True
+    
+    不支持 scalable 模式
+    """
+    
+    def __init__(self, capacity=5000000, err_rate=0.001,
+                 whitelist=UrlDedup.WHITELIST, blacklist=UrlDedup.BLACKLIST,
+                 path=None, path_template=False, mp_context=None,
+                 ):
+        import multiprocessing
+        import tempfile
+        
+        if mp_context is None:
+            mp_context = multiprocessing
+        
+        if path is None:
+            # /dev/shm 是内存文件系统, 位数组不会真的写入磁盘
+            path = tempfile.mkdtemp(
+                prefix="{}_".format(self.__class__.__name__),
+                dir="/dev/shm" if os.path.isdir("/dev/shm") else None,
+            )
+            self.auto_delete = True
+        else:
+            self.auto_delete = False
+        self._owner_pid = os.getpid()
+        
+        self.lock = mp_context.Lock()
+        self._shared_count = mp_context.RawValue("q", 0)
+        
+        super(SharedUrlDedup, self).__init__(
+            capacity=capacity, err_rate=err_rate,
+            whitelist=whitelist, blacklist=blacklist,
+            path=path, path_template=path_template,
+        )
+        if self.scalable:
+            raise ValueError("{} does not support scalable mode".format(self.__class__.__name__))
+        self._shared_count.value = self._count_base + len(self.bloom)
+    
+    def __getstate__(self):
+        return {
+            "whitelist": self.whitelist,
+            "blacklist": self.blacklist,
+            "path_template": self.path_template,
+            "path": self.path,
+            "lock": self.lock,
+            "_shared_count": self._shared_count,
+        }
+    
+    def __setstate__(self, state):
+        self.whitelist = state["whitelist"]
+        self.blacklist = state["blacklist"]
+        self.path_template = state["path_template"]
+        self.template_hits = collections.Counter()  # 各进程分别计数
+        self.lock = state["lock"]
+        self._shared_count = state["_shared_count"]
+        self.auto_delete = False  # 只由创建者删除
+        self._owner_pid = None
+        self._count_base = 0
+        self._load_bloom(state["path"])
+    
+    def _count(self):
+        return self._shared_count.value
+    
+    def occurs(self, url, auto_add=True):
+        key = self._key(url, count_template=auto_add)
+        
+        if not auto_add:
+            return key in self.bloom
+        
+        with self.lock:
+            seen = self.bloom.add(key)
+            if not seen:
+                self._shared_count.value += 1
+        return seen
+    
+    def occurs_many(self, urls, auto_add=True):
+        keys = self._keys(urls, count_template=auto_add)
+        
+        if not auto_add:
+            bloom = self.bloom
+            return [x in bloom for x in keys]
+        
+        add = self.bloom.add
+        with self.lock:
+            results = [add(x) for x in keys]
+            self._shared_count.value += results.count(False)
+        return results
+    
+    def save(self, path=None):
+        """只能对共享的目录做 checkpoint, 不能另存到其他位置"""
+        if self.path is not None and path is not None and os.path.abspath(path) != self.path:
+            raise ValueError("{} can only be saved to its own path {}".format(
+                self.__class__.__name__, self.path))
+        with self.lock:
+            super(SharedUrlDedup, self).save(path)
+    
+    def __del__(self):
+        if getattr(self, "auto_delete", False) and self._owner_pid == os.getpid():
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ExactUrlDedup(UrlDedup):
+    """
+    内存中的bloom + 磁盘上的精确集合 (DiskKV, 即leveldb) 两级去重, 没有假阳性
+    
+    bloom 认为没出现过的url一定没出现过, 直接返回 False, 只需要写入 (批量写入磁盘);
+      只有bloom认为 "出现过" 时才会去磁盘上确认,
+      所以只有真正重复的url, 以及很少量的bloom假阳性需要读磁盘
+    
+    磁盘上以归一化url的sha1 (20字节) 作为key, 所以bloom中存的也是这个sha1,
+      重新打开已有的磁盘数据时会用磁盘中的key重建bloom (或者用 path 直接加载bloom的快照)
+    
+    Examples:
+        >>> ud = ExactUrlDedup()
+        >>> ud.occurs("http://cat.com/foo?id=1")
+        False
+        >>> ud.occurs("http://cat.com/foo?id=2")
+        True
+        >>> ud.close()
+    
+    写入的url会先积攒在内存中, 每 batch_size 个用一次 WriteBatch 写入磁盘,
+      结束时请调用 `close()` (或 `flush()`), 否则最后一批可能没有写入磁盘
+    """
+    
+    def __init__(self, capacity=5000000, err_rate=0.001,
+                 whitelist=UrlDedup.WHITELIST, blacklist=UrlDedup.BLACKLIST,
+                 scalable=False, path=None, path_template=False,
+                 db=None, db_folder=None, batch_size=1000,
+                 ):
+        """
+        Args:
+            db (disk_kv_storge.DiskKV): 精确集合, 不传的话在 db_folder 创建一个
+            db_folder (str): 不传 db 时用来创建 DiskKV 的目录, 默认为自动删除的临时目录
+            batch_size (int): 每积攒多少个新url写入一次磁盘
+        """
+        bloom_loaded = path is not None and os.path.exists(os.path.join(path, "meta.json"))
+        super(ExactUrlDedup, self).__init__(
+            capacity=capacity, err_rate=err_rate,
+            whitelist=whitelist, blacklist=blacklist,
+            scalable=scalable, path=path, path_template=path_template,
+        )
+        
+        if db is None:
+            from disk_kv_storge import DiskKV
+            db = DiskKV(db_folder)
+            self._own_db = True
+        else:
+            self._own_db = False
+        self.db = db
+        self.batch_size = batch_size
+        self._pending = set()  # 还没写入磁盘的key
+        self.false_positives = 0  # bloom 的假阳性次数, 即被磁盘纠正的次数
+        
+        if not bloom_loaded:
+            # 用磁盘中已有的数据重建bloom
+            for key in self.db.keys(decode=False):
+                self.bloom.add(key)
+    
+    def _key(self, url, count_template=False):
+        return hashlib.sha1(super(ExactUrlDedup, self)._key(url, count_template)).digest()
+    
+    def _keys(self, urls, count_template=False):
+        sha1 = hashlib.sha1
+        return [sha1(x).digest() for x in super(ExactUrlDedup, self)._keys(urls, count_template)]
+    
+    def _occurs_key(self, key, auto_add):
+        if auto_add:
+            if not self.bloom.add(key):
+                self._put(key)
+                return False
+        elif key not in self.bloom:
+            return False
+        
+        # bloom 认为出现过, 查精确集合确认
+        if key in self._pending or self.db.rawget(key) is not None:
+            return True
+        
+        self.false_positives += 1
+        if auto_add:
+            self._put(key)
+        return False
+    
+    def _put(self, key):
+        self._pending.add(key)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        """把积攒的新url写入磁盘"""
+        if self._pending:
+            self.db.put_many((key, b"") for key in self._pending)
+            self._pending = set()
+    
+    def close(self):
+        self.flush()
+        if self._own_db:
+            self.db.close()
+    
+    def occurs(self, url, auto_add=True):
+        return self._occurs_key(self._key(url, count_template=auto_add), auto_add)
+    
+    def occurs_many(self, urls, auto_add=True):
+        occurs_key = self._occurs_key
+        return [occurs_key(key, auto_add) for key in self._keys(urls, count_template=auto_add)]
+
+
+class HostPartitionedDedup(UrlNormalizer):
+    """
+    按 host (netloc) 分区的去重
+    
+    每个host使用一个独立的小bloom (`ScalableBloomFilter`, 随着该host的url增多自动扩容),
+      在第一次遇到这个host时才创建, 单个大站不会占满所有host共用的容量
+    
+    host_quota:
+        每个host最多接受多少个不同的url, 达到配额后该host的url都视为 "已出现" (返回 True),
+        调用方就不会再继续入队了. 被拒绝的次数记录在 `quota_rejected`
+    
+    max_memory:
+        所有常驻内存的bloom的总大小上限 (字节), 超过后淘汰最久没有访问过的host的bloom.
+        传入 spill_dir 时, 被淘汰的bloom会写入磁盘, 下次访问时再 mmap 加载回来;
+        否则直接丢弃, 之后该host的url都会被当作新url
+    
+    Examples:
+        >>> ud = HostPartitionedDedup(host_quota=2)
+        >>> ud.occurs("http://cat.com/1")
+        False
+        >>> ud.occurs("http://cat.com/1")
+        True
+        >>> ud.occurs("http://cat.com/2")
+        False
+        >>> ud.occurs("http://cat.com/3")  # 超出配额
+        True
+        >>> ud.occurs("http://dog.com/3")
+        False
+    """
+    
+    def __init__(self, host_capacity=10000, err_rate=0.001,
+                 whitelist=UrlNormalizer.WHITELIST, blacklist=UrlNormalizer.BLACKLIST,
+                 path_template=False,
+                 host_quota=0, max_memory=0, spill_dir=None,
+                 ):
+        UrlNormalizer.__init__(self, whitelist, blacklist, path_template)
+        
+        self.host_capacity = host_capacity
+        self.err_rate = err_rate
+        self.host_quota = host_quota
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+        
+        # host --> [bloom, 占用的字节数]  按最近访问排序, 最久没访问的在最前
+        self.partitions = collections.OrderedDict()
+        self.memory = 0
+        self.host_counts = collections.Counter()  # 每个host接受的不同url数量
+        self.spilled = {}  # host --> 写入磁盘的子filter信息 (ScalableBloomFilter.save 的返回值)
+        self.quota_rejected = 0
+        self.evicted = 0
+    
+    @staticmethod
+    def _host(normalized_url):
+        if isinstance(normalized_url, six.text_type):
+            start = normalized_url.find("://")
+            if start != -1:
+                start += 3
+                end = len(normalized_url)
+                for char in "/?#":
+                    pos = normalized_url.find(char, start)
+                    if pos != -1 and pos < end:
+                        end = pos
+                return normalized_url[start:end]
+        try:
+            return parse.urlsplit(normalized_url).netloc
+        except:
+            return ""
+    
+    @staticmethod
+    def _bloom_bytes(bloom):
+        return sum(x.num_bits for x in bloom.filters) // 8
+    
+    def _spill_path(self, host):
+        if isinstance(host, six.text_type):
+            host = host.encode("UTF-8")
+        return os.path.join(self.spill_dir, hashlib.md5(host).hexdigest())
+    
+    def _partition(self, host, create=True):
+        """取出host对应的bloom, 并标记为最近访问过"""
+        try:
+            partition = self.partitions[host]
+        except KeyError:
+            pass
+        else:
+            self.partitions.move_to_end(host)
+            return partition[0]
+        
+        if host in self.spilled:
+            bloom = ScalableBloomFilter.open(self._spill_path(host), self.spilled.pop(host))
+        elif create:
+            bloom = ScalableBloomFilter(self.host_capacity, self.err_rate)
+        else:
+            return None
+        
+        nbytes = self._bloom_bytes(bloom)
+        self.partitions[host] = [bloom, nbytes]
+        self.memory += nbytes
+        self._evict(keep=host)
+        return bloom
+    
+    def _evict(self, keep=None):
+        """淘汰最久没有访问的bloom, 直到总大小不超过 max_memory"""
+        if not self.max_memory:
+            return
+        while self.memory > self.max_memory and len(self.partitions) > 1:
+            host = next(iter(self.partitions))
+            if host == keep:
+                break
+            bloom, nbytes = self.partitions.pop(host)
+            self.memory -= nbytes
+            self.evicted += 1
+            if self.spill_dir is not None:
+                self.spilled[host] = bloom.save(self._spill_path(host))
+    
+    def over_quota(self, host):
+        return bool(self.host_quota) and self.host_counts[host] >= self.host_quota
+    
+    def occurs(self, url, auto_add=True):
+        normalized_url = self._normalize(url, count_template=auto_add)
+        host = self._host(normalized_url)
+        key = normalized_url
+        if isinstance(key, six.text_type):
+            key = key.encode("UTF-8")
+        
+        bloom = self._partition(host, create=auto_add)
+        if bloom is None:
+            return False
+        if not auto_add:
+            return key in bloom
+        
+        if self.over_quota(host):
+            self.quota_rejected += 1
+            return True
+        
+        filter_count = len(bloom.filters)
+        if bloom.add(key):
+            return True
+        
+        self.host_counts[host] += 1
+        if len(bloom.filters) != filter_count:  # 扩容了, 重新计算大小
+            partition = self.partitions[host]
+            nbytes = self._bloom_bytes(bloom)
+            self.memory += nbytes - partition[1]
+            partition[1] = nbytes
+            self._evict(keep=host)
+        return False
+    
+    def occurs_many(self, urls, auto_add=True):
+        occurs = self.occurs
+        return [occurs(url, auto_add) for url in urls]
+
+
+class RequestDedup(UrlDedup):
+    """
+    请求级别的去重, 对象是 `requestfuzz.FuzzableRequest`
+    
+    标识为: method + 归一化后的url + body中所有参数的key路径
+      body 使用 `requestfuzz.recursive_parse.load` 递归解析,
+      form/json/嵌套在form中的json 等都会展开到叶子节点,
+      json列表的下标统一记为 null, 所以列表长度不同也视为同一个请求
+    各部分用json编码后拼接, key中含有 `/` `&` `=` 等字符时也不会与其他请求混淆
+    
+    白名单和黑名单的规则与url中的参数相同:
+      key路径中任意一级在黑名单中的叶子被丢弃, 最后一级在白名单中的叶子保留value
+    
+    bloom 的部分与 `UrlDedup` 完全相同, scalable/path/path_template/save/load 都可以使用
+    
+    Examples:
+        >>> from requestfuzz import FuzzableRequest
+        >>> rd = RequestDedup()
+        >>> rd.occurs(FuzzableRequest("http://cat.com/api", method="POST", data={"id": "1"}))
+        False
+        >>> rd.occurs(FuzzableRequest("http://cat.com/api", method="POST", data={"id": "2"}))
+        True
+        >>> rd.occurs(FuzzableRequest("http://cat.com/api", method="POST", data={"id": "2", "name": "x"}))
+        False
+        >>> rd.occurs(FuzzableRequest("http://cat.com/api", method="GET"))
+        False
+    """
+    
+    def _leaf_path(self, node):
+        """叶子节点的key路径(列表), 列表下标记为 None, 路径中有黑名单key时返回 None"""
+        path = []
+        while node.parent is not None:
+            if isinstance(node.parent.data, list):
+                path.append(None)
+            else:
+                key = "{}".format(node.key)
+                if key in self.blacklist:
+                    return None
+                path.append(key)
+            node = node.parent
+        path.reverse()
+        return path
+    
+    def _body_keys(self, request):
+        """body 中参数的 [key路径, 白名单的value或None], 排序去重后返回"""
+        from requestfuzz.recursive_parse import load
+        from requestfuzz.utils import ensure_unicode
+        
+        try:
+            body = request.bin_body
+            if not body:
+                return []
+            root = load(ensure_unicode(body))
+        except Exception as e:
+            logger.debug("unable to parse body of %s: %s", request.url, e)
+            return []
+        
+        keys = {}
+        for node in root.iter_all_leaves():
+            path = self._leaf_path(node)
+            if path is None:
+                continue
+            value = None
+            if node.key in self.whitelist:
+                value = ensure_unicode("{}".format(node.data))
+            key = [path, value]
+            keys[json.dumps(key)] = key
+        return [keys[k] for k in sorted(keys)]
+    
+    def _signature(self, request, count_template=False):
+        return json.dumps([
+            request.method.upper(),
+            self._normalize(six.text_type(request.url), count_template),
+            self._body_keys(request),
+        ])
+    
+    def _key(self, request, count_template=False):
+        return self._signature(request, count_template).encode("UTF-8")
+    
+    def _keys(self, requests, count_template=False):
+        return [self._key(request, count_template) for request in requests]
 
 
 def test_url_dedup():
@@ -206,6 +1426,372 @@ def test_url_dedup():
     assert ud.occurs("http://cat.com/?a=4&b=5&c=") is True  # 最后测试一下之前出现的
 
 
+def test_occurs_many():
+    urls = [
+        "http://cat.com/foo?z=x&a=b",
+        "http://cat.com/foo?a=1&z=2",  # 批次内重复
+        "http://cat.com/foo#frag",
+        "http://cat.com/foo",  # 批次内重复
+        "http://cat.com/?action=put&spm=1&id=1",
+        "http://cat.com/?action=get&id=1",
+        "http://cat.com/?id=2&action=put",  # 批次内重复
+        "http://[::1/foo?a=1",  # 解析失败的url
+    ]
+    
+    ud = UrlDedup()
+    assert ud._normalize_many(urls) == [ud._normalize(x) for x in urls]
+    assert ud.contains_many(urls) == [False] * len(urls)
+    ud_loop = UrlDedup()
+    expected = [ud_loop.occurs(x) for x in urls]
+    assert expected == [False, True, False, True, False, False, True, False]
+    assert ud.occurs_many(urls) == expected
+    assert ud.occurs_many(urls) == [True] * len(urls)
+    assert ud.contains_many(urls) == [True] * len(urls)
+    assert ud.occurs_many([]) == []
+
+
+def test_scalable():
+    ud = UrlDedup(capacity=1000, err_rate=0.001, scalable=True)
+    assert ud.fill_ratio == 0
+    assert ud.estimated_fpr == 0
+    
+    _total = 20000
+    _sum = sum(ud.occurs("http://dog.com/?id_{}=1".format(i)) for i in range(_total))
+    assert _sum < _total / 500.0, _sum / _total  # 扩容后误报率依然很低
+    for i in range(_total):
+        assert ud.occurs("http://dog.com/?id_{}=1".format(i)) is True
+    
+    assert len(ud.bloom.filters) > 1
+    assert ud.bloom.capacity >= _total
+    assert len(ud.bloom) == _total - _sum
+    assert 0 < ud.fill_ratio < 1
+    assert 0 < ud.estimated_fpr < 0.001
+    
+    # 固定容量下装满时, 估算的误报率约等于 err_rate
+    ud = UrlDedup(capacity=1000, err_rate=0.001)
+    _sum = sum(ud.occurs("http://dog.com/?id_{}=1".format(i)) for i in range(1000))
+    assert ud.fill_ratio == (1000 - _sum) / 1000.0
+    assert 0.0005 < ud.estimated_fpr < 0.002, ud.estimated_fpr
+
+
+def test_save_load():
+    import shutil
+    import tempfile
+    
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for scalable in (False, True):
+            path = os.path.join(tmpdir, "scalable" if scalable else "fixed")
+            _total = 3000 if scalable else 500
+            
+            ud = UrlDedup(capacity=1000, scalable=scalable, whitelist=frozenset(["act"]))
+            assert ud.occurs("http://cat.com/?act=1") is False
+            ud.save(path)
+            
+            # 之后的 checkpoint 写到同一个目录
+            _sum = sum(ud.occurs("http://dog.com/?id_{}=1".format(i)) for i in range(_total))
+            ud.save()
+            
+            ud2 = UrlDedup.load(path)
+            assert ud2.scalable is scalable
+            assert ud2.whitelist == frozenset(["act"])
+            assert ud2.blacklist == UrlDedup.BLACKLIST
+            assert ud2.fill_ratio == ud.fill_ratio
+            if scalable:
+                assert len(ud2.bloom.filters) > 1
+                assert len(ud2.bloom) == _total + 1 - _sum
+            assert ud2.occurs("http://cat.com/?act=1") is True
+            assert ud2.occurs("http://cat.com/?act=2") is False
+            for i in range(_total):
+                assert ud2.occurs("http://dog.com/?id_{}=1".format(i)) is True
+            
+            # 恢复后的修改同样可以继续 checkpoint
+            assert ud2.occurs("http://cat.com/new") is False
+            ud2.save()
+            ud3 = UrlDedup(path=path)
+            assert ud3.whitelist == frozenset(["act"])  # 使用保存时的设置, 而不是构造函数的默认值
+            assert ud3.occurs("http://cat.com/new") is True
+            assert ud3.occurs("http://cat.com/?act=1") is True
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _shared_worker(ud, urls, results):
+    results.put(sum(not x for x in ud.occurs_many(urls)))
+
+
+def test_shared_url_dedup():
+    import multiprocessing
+    
+    ud = SharedUrlDedup(capacity=100000)
+    assert ud.occurs("http://cat.com/?id=1") is False
+    
+    # 4个进程写入互相重叠的url, 每个不重复的url只会有一个进程得到 False
+    urls = ["http://dog.com/?id_{}=1".format(i) for i in range(20000)]
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_shared_worker, args=(ud, urls[i * 4000:i * 4000 + 8000], results))
+        for i in range(4)
+    ]
+    for p in processes:
+        p.start()
+    _sum = sum(results.get() for _ in processes)
+    for p in processes:
+        p.join()
+    
+    assert 20000 * 0.999 <= _sum <= 20000, _sum  # 允许很少量的假阳性
+    assert ud._count() == _sum + 1
+    assert all(ud.contains_many(urls))
+    assert ud.occurs("http://cat.com/?id=2") is True
+
+
+def test_path_template():
+    ud = UrlDedup(path_template=True)
+    
+    assert ud._normalize("http://cat.com/item/123?id=1") == "http://cat.com/item/{int}?id="
+    assert ud._normalize("http://cat.com/u/1f3a9c2e7b/1.html") == "http://cat.com/u/{hex}/{int}.html"
+    assert ud._normalize("http://cat.com/d/123e4567-e89b-12d3-a456-426614174000/x") \
+           == "http://cat.com/d/{uuid}/x"
+    assert ud._normalize("http://cat.com/f/d41d8cd98f00b204e9800998ecf8427e#frag") == "http://cat.com/f/{hash}"
+    assert ud._normalize("http://cat.com/about/facade/v2") == "http://cat.com/about/facade/v2"  # 不像id
+    assert ud._normalize("http://cat.com") == "http://cat.com"
+    
+    assert ud.occurs("http://cat.com/item/123") is False
+    assert ud.occurs("http://cat.com/item/124") is True
+    assert ud.occurs("http://cat.com/item/124.html") is False  # 后缀名不同
+    assert ud.occurs("http://cat.com/item/abc") is False
+    assert ud.occurs_many(["http://cat.com/item/125", "http://dog.com/item/1"]) == [True, False]
+    
+    # 只统计写入的url, 查询和单独的 _normalize 不计数
+    assert "http://cat.com/item/126" in ud
+    assert ud.contains_many(["http://cat.com/item/127"]) == [True]
+    top = ud.top_templates(2)
+    assert top[0][0] == "http://cat.com/item/{int}", top
+    assert top[0][1] == 3, top
+    
+    # bytes 的url同样使用模板
+    assert ud._normalize(b"http://cat.com/item/123#x") == b"http://cat.com/item/{int}"
+    assert ud.occurs(b"http://cat.com/bin/999") is False
+    assert ud.occurs(b"http://cat.com/bin/998") is True
+    
+    # 模板数量有上限
+    ud = UrlDedup(capacity=10000, path_template=True)
+    ud.MAX_TEMPLATES = 10
+    for i in range(100):
+        ud.occurs("http://big.com/item/{}".format(i))
+        ud.occurs("http://host{}.com/item/1".format(i))
+    assert len(ud.template_hits) <= 20
+    assert ud.top_templates(1) == [("http://big.com/item/{int}", 100)]
+    
+    # 默认不启用
+    assert UrlDedup()._normalize("http://cat.com/item/123") == "http://cat.com/item/123"
+
+
+def test_exact_url_dedup():
+    import shutil
+    import tempfile
+    
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # 误报率非常高的bloom, 会产生大量假阳性, 全靠磁盘纠正
+        ud = ExactUrlDedup(capacity=1000, err_rate=0.3, db_folder=tmpdir, batch_size=64)
+        urls = ["http://dog.com/?id_{}=1".format(i) for i in range(1000)]
+        
+        assert ud.occurs_many(urls[:500]) == [False] * 500
+        assert not any(ud.occurs(url) for url in urls[500:])
+        assert ud.false_positives > 0
+        assert all(ud.occurs(url) for url in urls)
+        assert ud.contains_many(["http://dog.com/?id_1=2", "http://dog.com/?id_x=1"]) == [True, False]
+        assert "http://dog.com/?id_x=1" not in ud
+        ud.close()
+        
+        # 重新打开时用磁盘数据重建bloom
+        ud = ExactUrlDedup(capacity=1000, err_rate=0.3, db_folder=tmpdir)
+        assert all(ud.occurs_many(urls))
+        assert ud.occurs("http://cat.com/new") is False
+        ud.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_request_dedup():
+    from requestfuzz import FuzzableRequest
+    
+    def post(url="http://cat.com/api?id=1", **kwargs):
+        return FuzzableRequest(url, method="POST", **kwargs)
+    
+    rd = RequestDedup()
+    
+    # form 与 嵌套在form中的json, value不同视为相同
+    assert rd.occurs(post(data="a=1&b={\"x\":1,\"y\":[1,2]}")) is False
+    assert rd.occurs(post(url="http://cat.com/api?id=2", data="a=2&b={\"x\":3,\"y\":[4]}")) is True
+    assert rd.occurs(post(data="a=1&b={\"x\":1,\"z\":[1,2]}")) is False  # 嵌套的key不同
+    
+    # json, 黑名单key被忽略, 白名单key保留value
+    assert rd.occurs(post(json={"user": {"name": "x"}, "action": "put", "_t": 1})) is False
+    assert rd.occurs(post(json={"user": {"name": "y"}, "action": "put"})) is True
+    assert rd.occurs(post(json={"user": {"name": "y"}, "action": "del"})) is False
+    
+    # method 不同
+    assert post(data="a=1") not in rd
+    assert rd.occurs(post(data="a=1")) is False
+    assert rd.occurs(FuzzableRequest("http://cat.com/api?id=1", method="PUT", data="a=1")) is False
+    
+    assert rd.occurs_many([post(data="a=9"), post(data="c=1"), post(data="c=2")]) == [True, False, True]
+    
+    # key中的特殊字符不会导致不同的请求混淆
+    assert rd.occurs(post(json={"a&b": 1})) is False
+    assert rd.occurs(post(json={"a": 1, "b": 1})) is False
+    assert rd.occurs(post(json={"x/y": 1})) is False
+    assert rd.occurs(post(json={"x": {"y": 1}})) is False
+    assert rd.occurs(post(json={"action": "a=b"})) is False
+    assert rd.occurs(post(json={"action": "a", "b": 1})) is False
+
+
+def test_host_partitioned_dedup():
+    import shutil
+    import tempfile
+    
+    ud = HostPartitionedDedup(host_capacity=100, host_quota=300)
+    assert isinstance(ud, UrlNormalizer) and not isinstance(ud, UrlDedup)
+    for i in range(1000):
+        ud.occurs("http://big.com/{}".format(i))
+    assert ud.host_counts["big.com"] == 300
+    assert ud.quota_rejected == 700
+    assert ud.over_quota("big.com")
+    assert ud.occurs("http://small.com/1") is False  # 其他host不受影响
+    assert ud.occurs("http://small.com/1#x") is True
+    assert "http://small.com/1" in ud
+    assert "http://unknown.com/1" not in ud
+    assert "unknown.com" not in ud.partitions
+    assert len(ud.partitions["big.com"][0].filters) > 1  # 大站的bloom自动扩容
+    
+    # 内存上限: 淘汰最久没访问的host
+    one_bloom = HostPartitionedDedup._bloom_bytes(ScalableBloomFilter(100, 0.001))
+    ud = HostPartitionedDedup(host_capacity=100, max_memory=one_bloom * 3)
+    for host in range(5):
+        ud.occurs("http://host{}.com/1".format(host))
+    assert len(ud.partitions) == 3
+    assert ud.evicted == 2
+    assert ud.memory <= one_bloom * 3
+    assert ud.occurs("http://host0.com/1") is False  # 被丢弃了
+    
+    # 写入磁盘后可以再加载回来
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ud = HostPartitionedDedup(host_capacity=100, max_memory=one_bloom * 3, spill_dir=tmpdir)
+        for host in range(5):
+            for i in range(150):
+                ud.occurs("http://host{}.com/{}".format(host, i))
+        assert len(ud.spilled) > 0
+        for host in range(5):
+            for i in range(150):
+                assert ud.occurs("http://host{}.com/{}".format(host, i)) is True
+        assert ud.occurs_many(["http://host0.com/new", "http://host0.com/new"]) == [False, True]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _random_url(rnd):
+    """随机生成各种正常/畸形的url, 用于 `test_normalize_fast`"""
+    # 正常的片段出现的概率更高一些
+    scheme = rnd.choice(["http://"] * 4 + ["https://"] * 2 + ["HTTP://", "ftp://", "http:", "http:///", "//", ""])
+    netloc = rnd.choice(["cat.com"] * 4 + ["cat.com:8080", "u:p@cat.com", "[::1]", "[::1", "cat.com]", "",
+                                           "\u4e2d\u6587.com", "CAT.com"])
+    path = "".join(rnd.choice(["/", "/a", "/B", "/item", "/1", "//", "/%20", "/\u00e9", "/;x", " ", "\t"])
+                   for _ in range(rnd.randint(0, 3)))
+    
+    chars = ["a", "b", "c", "A", "id", "_", "spm", "action", "method", "~", ".", "-", "1", "2"] * 3 \
+            + ["%", "%20", "%2", "+", " ", ";", "=", "&", "?", "/", "#", "\u00e9"]
+    query = "&".join(
+        "".join(rnd.choice(chars) for _ in range(rnd.randint(0, 3)))
+        + rnd.choice(["=", "", "=="])
+        + "".join(rnd.choice(chars) for _ in range(rnd.randint(0, 3)))
+        for _ in range(rnd.randint(0, 4))
+    )
+    
+    url = scheme + netloc + path
+    if rnd.random() < 0.8:
+        url += "?" + query
+    if rnd.random() < 0.3:
+        url += "#" + rnd.choice(["", "frag", "x?y=1", "#"])
+    return url
+
+
+def test_normalize_fast():
+    import random
+    
+    ud = UrlDedup()
+    for url in [
+        "http://cat.com",
+        "http://cat.com/foo#frag",
+        "http://cat.com/foo#",
+        "http://cat.com/foo?",
+        "http://cat.com/foo?#",
+        "http://cat.com/foo?#frag",
+        "http://cat.com/foo?&&",
+        "http://cat.com/foo?spm=1",
+        "http://cat.com/foo?a&b=&=c",
+        "http://cat.com/foo?b=1&a=2&a=1&action=z&action=a#x",
+        "http://cat.com/foo?action=a%20b&id=%zz",
+        "http://cat.com/foo?a%20b=1",
+        "https://cat.com:8080/foo?x=1?y=2",
+    ]:
+        assert ud._normalize(url) == ud._normalize_slow(url), url
+    
+    assert ud._normalize_fast("http://cat.com/?y=2&x=1") == "http://cat.com/?x=&y="
+    assert ud._normalize_fast("http://cat.com/?id=%E4%B8%AD") == "http://cat.com/?id="
+    assert ud._normalize_fast("HTTP://cat.com/?id=1") is None  # 慢速路径会把scheme转为小写
+    assert ud._normalize_fast("http://[::1]/?id=1") is None
+    assert ud._normalize_fast("http://cat.com/?a+b=1") is None  # key 需要解码
+    
+    # fuzz
+    rnd = random.Random(42)
+    fast_count = 0
+    for _ in range(30000):
+        url = _random_url(rnd)
+        if ud._normalize_fast(url) is not None:
+            fast_count += 1
+        assert ud._normalize(url) == ud._normalize_slow(url), url
+    assert fast_count > 2000, fast_count  # 确认确实测到了快速路径
+
+
+def benchmark_occurs_many(total=1000000, batch_size=10000):
+    """对比 逐个 occurs() 与 批量 occurs_many() 的耗时"""
+    urls = [
+        "http://site{}.com/item/{}?id={}&page={}&spm={}".format(i % 50, i % 1000, i, i % 7, i)
+        for i in range(total)
+    ]
+    
+    ud = UrlDedup(capacity=total)
+    start = time.time()
+    loop_result = [ud.occurs(url) for url in urls]
+    loop_cost = time.time() - start
+    
+    ud = UrlDedup(capacity=total)
+    start = time.time()
+    batch_result = []
+    for i in range(0, total, batch_size):
+        batch_result.extend(ud.occurs_many(urls[i:i + batch_size]))
+    batch_cost = time.time() - start
+    
+    assert loop_result == batch_result
+    print("occurs() loop: {:.2f}s  occurs_many(): {:.2f}s  ({} urls, batch_size={})".format(
+        loop_cost, batch_cost, total, batch_size))
+
+
 if __name__ == '__main__':
-    test_url_dedup()
-    print("all tests passed!")
+    if "--bench" in sys.argv[1:]:
+        benchmark_occurs_many()
+    else:
+        test_url_dedup()
+        test_occurs_many()
+        test_normalize_fast()
+        test_path_template()
+        test_scalable()
+        test_save_load()
+        test_shared_url_dedup()
+        test_exact_url_dedup()
+        test_host_partitioned_dedup()
+        test_request_dedup()
+        print("all tests passed!")